@@ -1,5 +1,8 @@
 import os
+import shutil
 import subprocess
+import tempfile
+from json import loads as j_loads
 
 bitrate_table = {
     "2160p": 14000,
@@ -11,6 +14,22 @@ bitrate_table = {
     "240p": 500,
 }
 
+# Encoders used to re-render the boundary GOPs of a clip, by source codec
+smart_render_encoders = {
+    "h264": "libx264",
+    "hevc": "libx265",
+}
+# MP4 sample entries that carry parameter sets in-band, by source codec. The re-encoded
+# pieces of a clip have parameter sets of their own, which avc1/hvc1 cannot signal.
+in_band_sample_entries = {
+    "h264": "avc3",
+    "hevc": "hev1",
+}
+# Cut points closer than this to a keyframe (in seconds) are treated as on the keyframe
+keyframe_tolerance = 0.001
+# Longest GOP expected in a source, in seconds. Keyframes are only read this far around a clip
+max_gop_duration = 10.0
+
 
 def get_basename_directory_path(file_path: str) -> str:
     """
@@ -116,6 +135,280 @@ def split_video(input_file: str, output_dir: str) -> None:
         print(f"Error splitting video: {e}")
 
 
+def get_video_packets(input_file: str, start: float = None, end: float = None,
+                      start_time: float = 0.0) -> list:
+    """
+    Lists the packets of the first video stream in decode order. Only packet headers
+    are read, nothing is decoded. Given a range, only the packets within
+    max_gop_duration of it are read instead of the whole file.
+
+    Args:
+        input_file (str): Path to the video file.
+        start (float): Optional range start in seconds.
+        end (float): Optional range end in seconds.
+        start_time (float): The container start time from probe_clip_source. It is
+            subtracted from the packet times, so they match ffmpeg's -ss positions.
+
+    Returns:
+        list of tuple: (presentation time in seconds, is keyframe) per packet.
+    """
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+    ]
+    if start is not None and end is not None:
+        # Interval bounds are absolute timestamps, so they include the start time
+        interval_start = start_time + max(0.0, start - max_gop_duration)
+        interval_end = start_time + end + max_gop_duration
+        command += ["-read_intervals", f"{interval_start:.6f}%{interval_end:.6f}"]
+    command += [
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        input_file
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+
+    packets = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if pts_time not in ("", "N/A"):
+            packets.append((float(pts_time) - start_time, "K" in flags))
+    return packets
+
+
+def get_keyframe_times(packets: list) -> list:
+    """
+    Lists the keyframes a clip can be cut at. A keyframe followed in decode order by
+    frames shown before it (the leading pictures of an open GOP) is skipped, since
+    those frames belong to the previous GOP on screen but to the next one in the file.
+
+    Args:
+        packets (list of tuple): Packets from get_video_packets, in decode order.
+
+    Returns:
+        list of float: Keyframe times in seconds, sorted.
+    """
+    keyframes = []
+    for index, (time, keyframe) in enumerate(packets):
+        if not keyframe:
+            continue
+        following = []
+        for next_time, next_keyframe in packets[index + 1:]:
+            if next_keyframe:
+                break
+            following.append(next_time)
+        if all(next_time > time for next_time in following):
+            keyframes.append(time)
+    return sorted(keyframes)
+
+
+def probe_clip_source(input_file: str) -> dict:
+    """
+    Probes the codec of the first video stream, the container start time and whether
+    the file has an audio stream.
+
+    Args:
+        input_file (str): Path to the video file.
+
+    Returns:
+        dict: The video "codec", "start_time" in seconds (0.0 if unknown) and "has_audio".
+    """
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name:format=start_time",
+        "-of", "json",
+        input_file
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    video_info = j_loads(result.stdout)
+    streams = video_info.get('streams', [])
+    video_streams = [s for s in streams if s.get('codec_type') == "video"]
+    if not video_streams:
+        raise ValueError(f"No video stream in {input_file}")
+    start_time = video_info.get('format', {}).get('start_time')
+    return {
+        "codec": video_streams[0].get('codec_name'),
+        "start_time": float(start_time) if start_time not in (None, "N/A") else 0.0,
+        "has_audio": any(s.get('codec_type') == "audio" for s in streams),
+    }
+
+
+def get_matching_encoder_args(input_file: str) -> list:
+    """
+    Builds encoder options that reproduce the codec, profile, pixel format, bitrate and
+    colour signalling of the first video stream, so re-rendered GOPs can be joined to
+    stream-copied ones.
+
+    Args:
+        input_file (str): Path to the video file.
+
+    Returns:
+        list of str: ffmpeg video encoder options.
+    """
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,profile,level,pix_fmt,bit_rate,color_primaries,color_transfer,"
+                         "color_space:format=bit_rate",
+        "-of", "json",
+        input_file
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    video_info = j_loads(result.stdout)
+    if not video_info.get('streams'):
+        raise ValueError(f"No video stream in {input_file}")
+    stream = video_info['streams'][0]
+
+    codec_name = stream.get('codec_name')
+    if codec_name not in smart_render_encoders:
+        raise ValueError(f"Smart rendering supports {list(smart_render_encoders)} sources, got {codec_name}")
+
+    args = ["-c:v", smart_render_encoders[codec_name]]
+    profile = (stream.get('profile') or "").lower().replace(" ", "").replace(":", "")
+    profile = {"constrainedbaseline": "baseline", "high444predictive": "high444"}.get(profile, profile)
+    if profile:
+        args += ["-profile:v", profile]
+    if codec_name == "h264" and stream.get('level', 0) > 0:
+        args += ["-level", f"{stream['level'] / 10:.1f}"]
+    if stream.get('pix_fmt'):
+        args += ["-pix_fmt", stream['pix_fmt']]
+
+    bit_rate = stream.get('bit_rate') or video_info.get('format', {}).get('bit_rate')
+    if bit_rate:
+        args += ["-b:v", str(bit_rate)]
+    else:
+        args += ["-crf", "18"]
+
+    for key, option in (("color_primaries", "-color_primaries"), ("color_transfer", "-color_trc"),
+                        ("color_space", "-colorspace")):
+        if stream.get(key) not in (None, "unknown"):
+            args += [option, stream[key]]
+    return args
+
+
+def plan_clip(keyframes: list, start: float, end: float) -> list:
+    """
+    Splits a clip into the partial GOP before the first keyframe, the whole GOPs that
+    can be stream-copied, and the partial GOP after the last keyframe.
+
+    Args:
+        keyframes (list of float): Sorted keyframe times from get_keyframe_times.
+        start (float): Clip start in seconds.
+        end (float): Clip end in seconds.
+
+    Returns:
+        list of tuple: (start, end, "encode" or "copy") pieces in order.
+    """
+    inner = [t for t in keyframes if start - keyframe_tolerance <= t <= end + keyframe_tolerance]
+    if not inner or inner[0] >= end - keyframe_tolerance:
+        # No keyframe inside the clip, so there is nothing to copy
+        return [(start, end, "encode")]
+
+    first_keyframe, last_keyframe = inner[0], inner[-1]
+    pieces = []
+    if first_keyframe - start > keyframe_tolerance:
+        pieces.append((start, first_keyframe, "encode"))
+    if last_keyframe - first_keyframe > keyframe_tolerance:
+        pieces.append((first_keyframe, last_keyframe, "copy"))
+    else:
+        # A single keyframe leaves no whole GOP, so encode the clip in one piece
+        return [(start, end, "encode")]
+    if end - last_keyframe > keyframe_tolerance:
+        pieces.append((last_keyframe, end, "encode"))
+    return pieces
+
+
+def extract_clip(input_file: str, output_file: str, start: float, end: float) -> list:
+    """
+    Cuts a frame-accurate clip while re-encoding only the partial GOPs at its
+    boundaries. The GOPs in between are stream-copied. The video pieces are joined
+    through MPEG-TS, which carries the parameter sets of each piece in-band, into an
+    MP4 with an avc3/hev1 sample entry that keeps them in-band, and the audio of the
+    whole range, if the source has any, is stream-copied.
+
+    Args:
+        input_file (str): Path to the source video (H.264 or HEVC).
+        output_file (str): Path of the clip, e.g. "clips/goal.mp4".
+        start (float): Clip start in seconds.
+        end (float): Clip end in seconds.
+
+    Returns:
+        list of tuple: The (start, end, "encode" or "copy") pieces the clip was built from.
+    """
+    if end <= start:
+        raise ValueError(f"Clip end {end} is not after its start {start}")
+
+    source_info = probe_clip_source(input_file)
+    packets = get_video_packets(input_file, start, end, source_info["start_time"])
+    pieces = plan_clip(get_keyframe_times(packets), start, end)
+    encoder_args = get_matching_encoder_args(input_file)
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+
+    work_dir = tempfile.mkdtemp(prefix=".clip-", dir=output_dir)
+    try:
+        piece_files = []
+        for index, (piece_start, piece_end, action) in enumerate(pieces):
+            piece_file = os.path.join(work_dir, f"piece_{index}.ts")
+            # -t alone lets frames past the piece end through: copied packets are cut by
+            # decode time, and encoded frames are rounded to the encoder time base first
+            frame_count = sum(
+                1 for time, _ in packets
+                if piece_start - keyframe_tolerance <= time < piece_end - keyframe_tolerance
+            )
+            command = [
+                "ffmpeg",
+                "-ss", f"{piece_start:.6f}",
+                "-i", input_file,
+                "-t", f"{piece_end - piece_start:.6f}",
+                "-frames:v", str(frame_count),
+                "-map", "0:v:0",
+                "-an",
+            ]
+            if action == "copy":
+                command += ["-c:v", "copy"]
+            else:
+                command += encoder_args
+            command += ["-f", "mpegts", "-y", piece_file]
+            subprocess.run(command, capture_output=True, check=True)
+            piece_files.append(piece_file)
+
+        # Audio packets are short enough that copying them is accurate to well under a frame
+        audio_file = os.path.join(work_dir, "audio.mka")
+        if source_info["has_audio"]:
+            command = [
+                "ffmpeg",
+                "-ss", f"{start:.6f}",
+                "-i", input_file,
+                "-t", f"{end - start:.6f}",
+                "-map", "0:a",
+                "-vn",
+                "-c:a", "copy",
+                "-y", audio_file
+            ]
+            subprocess.run(command, capture_output=True, check=True)
+
+        concat_list = os.path.join(work_dir, "pieces.txt")
+        with open(concat_list, "w") as file:
+            file.writelines(f"file '{os.path.basename(piece_file)}'\n" for piece_file in piece_files)
+
+        # Not named *.mp4, so find_mp4_files never picks up a half-written clip
+        part_file = f"{output_file}.part"
+        command = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_list]
+        if source_info["has_audio"]:
+            command += ["-i", audio_file, "-map", "0:v", "-map", "1:a"]
+        command += ["-c", "copy", "-tag:v", in_band_sample_entries[source_info["codec"]], "-f", "mp4", "-y", part_file]
+        subprocess.run(command, capture_output=True, check=True)
+        os.replace(part_file, output_file)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return pieces
+
+
 def create_dash_manifest():
     raise NotImplementedError
 
@@ -124,6 +417,8 @@ if __name__ == "__main__":
     # scale_video("stickman-animation.mp4", ["240p", "480p", "720p", "1080p"],
     #             "dash_test/mp4")
 
+    # extract_clip("dash_test/mp4/stickman-animation_1080p.mp4", "dash_test/clips/intro.mp4", 1.5, 7.25)
+
     split_video("dash_test/mp4/stickman-animation_240p.mp4", "dash_test/dash/240p/")
     split_video("dash_test/mp4/stickman-animation_480p.mp4", "dash_test/dash/480p/")
     split_video("dash_test/mp4/stickman-animation_720p.mp4", "dash_test/dash/720p/")
@@ -1,6 +1,9 @@
 import os
+import sqlite3
 import subprocess
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 import requests
 from tqdm import tqdm
 
@@ -14,34 +17,196 @@ def generate_file_urls(_url: str, segment_limit=159) -> List[str]:
     return files
 
 
-def download_file(_url: str, destination: str) -> None:
+def open_download_cache(cache_path: str) -> sqlite3.Connection:
+    """
+    Opens (and creates if needed) the metadata cache that remembers the validators
+    of every downloaded URL, so later runs can revalidate instead of re-downloading.
+
+    Parameters:
+    cache_path (str): The path to the SQLite cache file.
+
+    Returns:
+    sqlite3.Connection: The open cache.
+    """
+    cache = sqlite3.connect(cache_path)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS downloads ("
+        " url TEXT PRIMARY KEY,"
+        " path TEXT NOT NULL,"
+        " etag TEXT,"
+        " last_modified TEXT,"
+        " content_length INTEGER,"
+        " checked_at REAL NOT NULL)"
+    )
+    return cache
+
+
+def get_cache_entry(cache: sqlite3.Connection, _url: str) -> dict:
+    """
+    Returns the cached validators of a URL, or None if it was never downloaded.
+    """
+    row = cache.execute(
+        "SELECT path, etag, last_modified, content_length FROM downloads WHERE url = ?", (_url,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"path": row[0], "etag": row[1], "last_modified": row[2], "content_length": row[3]}
+
+
+def update_cache_entry(cache: sqlite3.Connection, _url: str, destination: str, headers,
+                       content_length: int = None) -> None:
+    """
+    Stores the validators of a response. Validators missing from a 304 response are kept.
+    """
+    entry = get_cache_entry(cache, _url) or {}
+    if content_length is None and "Content-Length" in headers:
+        content_length = int(headers["Content-Length"])
+    cache.execute(
+        "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            _url,
+            destination,
+            headers.get("ETag", entry.get("etag")),
+            headers.get("Last-Modified", entry.get("last_modified")),
+            content_length if content_length is not None else entry.get("content_length"),
+            time.time(),
+        ),
+    )
+    cache.commit()
+
+
+def resolve_destination(_url: str, destination: str) -> str:
+    # If a directory is provided, save to that directory
+    if destination.endswith("/"):
+        basename = _url.split("/")[-1]
+        destination = f"{destination}{basename}"
+    return destination
+
+
+def download_file(_url: str, destination: str, cache: sqlite3.Connection = None,
+                  session: requests.Session = None) -> str:
     """
     Downloads a file from the given URL and saves it to the specified destination.
 
+    Without a cache, existing files are skipped. With a cache, existing files are
+    revalidated with If-None-Match/If-Modified-Since and only re-downloaded when
+    they changed upstream, and truncated files are completed with a Range request.
+
     Parameters:
     url (str): The URL of the file to download.
     destination (str): The path where the downloaded file should be saved.
+    cache (sqlite3.Connection): The metadata cache from open_download_cache.
+    session (requests.Session): A session to reuse connections across calls.
+
+    Returns:
+    str: One of "downloaded", "resumed", "not-modified", "skipped" or "failed".
     """
-    try:
-        with requests.get(_url, stream=True) as response:
-            # If a directory is provided, save to that directory
-            if destination.endswith("/"):
-                basename = _url.split("/")[-1]
-                destination = f"{destination}{basename}"
+    destination = resolve_destination(_url, destination)
+    http = session or requests
+
+    # Check if the file already exists
+    local_size = os.path.getsize(destination) if os.path.exists(destination) else None
+    if local_size is not None and cache is None:
+        # print(f"File already exists: {destination}. Skipping download.")
+        return "skipped"
+
+    entry = get_cache_entry(cache, _url) if cache is not None else None
+    validator = entry and (entry["etag"] or entry["last_modified"])
+    headers = {}
+    if local_size is not None and validator:
+        expected_size = entry["content_length"]
+        if expected_size is not None and local_size < expected_size:
+            # Truncated: fetch only the missing tail, unless the file changed in the meantime
+            headers["Range"] = f"bytes={local_size}-"
+            headers["If-Range"] = validator
+        elif expected_size is None or local_size == expected_size:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
 
-            # Check if the file already exists
-            if os.path.exists(destination):
-                # print(f"File already exists: {destination}. Skipping download.")
-                return
+    try:
+        with http.get(_url, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                update_cache_entry(cache, _url, destination, response.headers)
+                return "not-modified"
 
             response.raise_for_status()  # Check for HTTP request errors
-            with open(destination, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
+
+            if response.status_code == 206:
+                with open(destination, "ab") as file:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        file.write(chunk)
+                status = "resumed"
+            else:
+                # Write next to the destination first, so a failed transfer never replaces a good file
+                with open(f"{destination}.part", "wb") as file:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        file.write(chunk)
+                os.replace(f"{destination}.part", destination)
+                status = "downloaded"
+
+            if cache is not None:
+                # The Content-Length of a 206 response only covers the requested range
+                update_cache_entry(cache, _url, destination, response.headers, os.path.getsize(destination))
 
         # print(f"File downloaded successfully: {destination}")
+        return status
     except requests.exceptions.RequestException as e:
         print(f"Failed to download the file: {e}")
+        return "failed"
+
+
+def check_file(_url: str, destination: str, entry: dict, session: requests.Session = None) -> str:
+    """
+    Compares a local file and its cache entry against a HEAD request for its URL.
+
+    Returns:
+    str: One of "ok", "missing", "truncated", "changed", "uncached" or "failed".
+    """
+    if not os.path.exists(destination):
+        return "missing"
+    if entry is None:
+        return "uncached"
+
+    try:
+        response = (session or requests).head(_url, allow_redirects=True)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to check the file: {e}")
+        return "failed"
+
+    remote_length = response.headers.get("Content-Length")
+    remote_length = int(remote_length) if remote_length is not None else entry["content_length"]
+    if response.headers.get("ETag", entry["etag"]) != entry["etag"] \
+            or response.headers.get("Last-Modified", entry["last_modified"]) != entry["last_modified"] \
+            or remote_length != entry["content_length"]:
+        return "changed"
+    if os.path.getsize(destination) != entry["content_length"]:
+        return "truncated"
+    return "ok"
+
+
+def verify_files(urls: List[str], destination: str, cache: sqlite3.Connection,
+                 max_workers: int = 8) -> Dict[str, str]:
+    """
+    Checks local files against the cache and the server with parallel HEAD requests,
+    without downloading anything.
+
+    Parameters:
+    urls (list of str): The URLs to check.
+    destination (str): The directory (ending with "/") or path the files were saved to.
+    cache (sqlite3.Connection): The metadata cache from open_download_cache.
+    max_workers (int): Number of concurrent HEAD requests.
+
+    Returns:
+    dict: Maps each URL to its check_file status.
+    """
+    # SQLite connections stay on this thread; only the HEAD requests run in the pool
+    jobs = [(_url, resolve_destination(_url, destination), get_cache_entry(cache, _url)) for _url in urls]
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = executor.map(lambda job: check_file(*job, session=session), jobs)
+        return dict(zip(urls, tqdm(statuses, total=len(jobs), desc="Verifying", unit="files")))
 
 
 folder_urls = [
@@ -59,18 +224,35 @@ folder_urls = [
     # "https://dash.akamaized.net/akamai/bbb_30fps/bbb_30fps_1920x1080_8000k/",
 ]
 
-for base_url in folder_urls:
-    file_urls = generate_file_urls(base_url)
+if __name__ == "__main__":
+    # Set to True to only check local files against the server instead of re-mirroring
+    verify_only = False
+
+    os.makedirs("downloads", exist_ok=True)
+    download_cache = open_download_cache("downloads/.download_cache.sqlite")
+
+    for base_url in folder_urls:
+        file_urls = generate_file_urls(base_url)
+
+        download_dir = "downloads/" + base_url[34:]
 
-    download_dir = "downloads/" + base_url[34:]
+        # Ensure the target directory exists
+        os.makedirs(download_dir, exist_ok=True)
 
-    # Ensure the target directory exists
-    os.makedirs(download_dir, exist_ok=True)
+        if verify_only:
+            results = verify_files(file_urls, download_dir, download_cache)
+            problems = {url: status for url, status in results.items() if status != "ok"}
+            print(f"{len(results) - len(problems)} files up to date, {len(problems)} need attention")
+            for url, status in problems.items():
+                print(f"{status}: {url}")
+            continue
 
-    # Initialize the tqdm progress bar
-    for file_url in tqdm(file_urls, desc=f"Downloading {base_url}", unit="files"):
-        # print(file_url)
-        # exit(-1)
-        download_file(file_url, download_dir)
+        # Initialize the tqdm progress bar
+        with requests.Session() as http_session:
+            for file_url in tqdm(file_urls, desc=f"Downloading {base_url}", unit="files"):
+                # print(file_url)
+                # exit(-1)
+                download_file(file_url, download_dir, download_cache, http_session)
 
-print("Download process completed.")
+    download_cache.close()
+    print("Download process completed.")
@@ -0,0 +1,378 @@
+import csv
+import glob
+import os
+import random
+import shutil
+import subprocess
+
+from dash_manifest import build_ladder_command
+from mpd_parser import parse_mpd_segments
+from video_probe import probe_video
+
+# Player model
+max_buffer = 30.0  # Seconds of media the player buffers ahead before it pauses downloading
+startup_buffer = 2.0  # Seconds of media buffered before playback starts
+throughput_window = 5  # Segments averaged by the throughput rule
+throughput_safety = 0.9  # Fraction of the estimated throughput the throughput rule spends
+bba_reservoir = 5.0  # Buffer level in seconds below which BBA picks the lowest bitrate
+bba_cushion = 10.0  # Buffer range in seconds over which BBA ramps up to the highest bitrate
+
+
+def load_ladders(mpd_path: str) -> dict:
+    """
+    Reads the video AdaptationSets of a static MPD with the real size of every media
+    segment on disk. Segments that are missing are sized from the nominal bandwidth.
+    A player only switches within one AdaptationSet, so every set, e.g. one per codec,
+    is a ladder of its own.
+
+    Args:
+        mpd_path (str): The path to the MPD file.
+
+    Returns:
+        dict: Maps a label per AdaptationSet, its codec family like "avc1" or "hvc1", to
+        its Representations from lowest to highest bandwidth, each with its "id",
+        "bandwidth" (bits/s), "height" and "segments" as (duration in seconds, bytes) tuples.
+    """
+    mpd_dir = os.path.dirname(os.path.abspath(mpd_path))
+    adaptation_sets = {}
+    for representation_id, representation in parse_mpd_segments(mpd_path).items():
+        if representation["content_type"] not in ("video", ""):
+            continue
+        segments = []
+        for path, seconds in zip(representation["media"], representation["durations"]):
+            path = os.path.join(mpd_dir, path)
+            size = os.path.getsize(path) if os.path.isfile(path) else int(representation["bandwidth"] * seconds / 8)
+            segments.append((seconds, size))
+
+        adaptation_set = adaptation_sets.setdefault(representation["adaptation_set"], {
+            "codec": representation["codecs"].split(".")[0] or f"set{representation['adaptation_set']}",
+            "ladder": [],
+        })
+        adaptation_set["ladder"].append({
+            "id": representation_id,
+            "bandwidth": representation["bandwidth"],
+            "height": representation["height"],
+            "segments": segments,
+        })
+
+    if not adaptation_sets:
+        raise ValueError(f"{mpd_path} has no video Representations")
+
+    ladders = {}
+    for set_id, adaptation_set in adaptation_sets.items():
+        label = adaptation_set["codec"]
+        if label in ladders:
+            label = f"{label}-{set_id}"
+        ladders[label] = sorted(adaptation_set["ladder"], key=lambda rung: rung["bandwidth"])
+    return ladders
+
+
+def load_trace(trace_path: str) -> list:
+    """
+    Reads a bandwidth trace with one "<seconds> <kbit/s>" pair per line, e.g. converted
+    from a recorded network log. Blank lines and lines starting with "#" are ignored.
+
+    Args:
+        trace_path (str): The path to the trace file.
+
+    Returns:
+        list of tuple: (duration in seconds, throughput in bits/s) periods.
+    """
+    trace = []
+    with open(trace_path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            seconds, kbps = line.split()[:2]
+            trace.append((float(seconds), float(kbps) * 1000))
+    return trace
+
+
+def synthetic_trace(mean_kbps: float, duration: float = 600, period: float = 1.0,
+                    variability: float = 0.3, seed: int = 0) -> list:
+    """
+    Generates a bandwidth trace as a mean-reverting random walk around a mean throughput.
+
+    Args:
+        mean_kbps (float): The mean throughput in kbit/s.
+        duration (float): The length of the trace in seconds.
+        period (float): The length of each constant-throughput period in seconds.
+        variability (float): Relative standard deviation of each step. 0 gives a constant trace.
+        seed (int): Random seed, so sweeps are reproducible.
+
+    Returns:
+        list of tuple: (duration in seconds, throughput in bits/s) periods.
+    """
+    rng = random.Random(seed)
+    kbps = mean_kbps
+    trace = []
+    for _ in range(max(1, int(duration / period))):
+        kbps += 0.5 * (mean_kbps - kbps) + rng.gauss(0, variability * mean_kbps)
+        kbps = max(0.05 * mean_kbps, kbps)
+        trace.append((period, kbps * 1000))
+    return trace
+
+
+def get_download_time(trace: list, start: float, size: int) -> float:
+    """
+    Returns how long downloading a segment takes when it starts at a given time of a
+    trace. The trace repeats when it runs out.
+
+    Args:
+        trace (list of tuple): (duration in seconds, throughput in bits/s) periods.
+        start (float): The time the download starts, in seconds.
+        size (int): The segment size in bytes.
+
+    Returns:
+        float: The download time in seconds.
+    """
+    trace_duration = sum(duration for duration, _ in trace)
+    bits = size * 8
+    elapsed = 0.0
+    offset = start % trace_duration
+    index = 0
+    while offset >= trace[index][0]:
+        offset -= trace[index][0]
+        index += 1
+
+    while True:
+        duration, throughput = trace[index]
+        available = (duration - offset) * throughput
+        if available >= bits:
+            return elapsed + bits / throughput
+        bits -= available
+        elapsed += duration - offset
+        offset = 0.0
+        index = (index + 1) % len(trace)
+
+
+def throughput_rule(ladder: list, state: dict) -> int:
+    """
+    Picks the highest bitrate below a safety fraction of the harmonic mean of the last
+    measured segment throughputs. The harmonic mean is dominated by the slow samples,
+    so one fast download does not cause an upswitch.
+    """
+    samples = state["throughputs"][-throughput_window:]
+    if not samples:
+        return 0
+    estimate = throughput_safety * len(samples) / sum(1 / sample for sample in samples)
+    quality = 0
+    for index, rung in enumerate(ladder):
+        if rung["bandwidth"] <= estimate:
+            quality = index
+    return quality
+
+
+def buffer_rule(ladder: list, state: dict) -> int:
+    """
+    Buffer-based adaptation (BBA): the lowest bitrate while the buffer is below the
+    reservoir, the highest above reservoir + cushion, and a linear map of the buffer
+    level onto the bitrate range in between.
+    """
+    buffer = state["buffer"]
+    if buffer <= bba_reservoir:
+        return 0
+    if buffer >= bba_reservoir + bba_cushion:
+        return len(ladder) - 1
+
+    lowest, highest = ladder[0]["bandwidth"], ladder[-1]["bandwidth"]
+    target = lowest + (buffer - bba_reservoir) / bba_cushion * (highest - lowest)
+    quality = 0
+    for index, rung in enumerate(ladder):
+        if rung["bandwidth"] <= target:
+            quality = index
+    return quality
+
+
+abr_algorithms = {
+    "throughput": throughput_rule,
+    "buffer": buffer_rule,
+}
+
+
+def simulate_playback(ladder: list, trace: list, algorithm) -> dict:
+    """
+    Replays a bandwidth trace through an ABR algorithm, downloading one segment at a time.
+
+    Args:
+        ladder (list of dict): The Representations of one AdaptationSet from load_ladders.
+        trace (list of tuple): (duration in seconds, throughput in bits/s) periods.
+        algorithm: Picks a ladder index from the ladder and the player state.
+
+    Returns:
+        dict: "startup_delay" and "rebuffer_seconds" in seconds, "rebuffer_ratio" (stalled
+        time over stalled plus played time), "switches", the "average_bitrate" (nominal
+        bandwidth weighted by segment duration, kbit/s) and the "delivered_bitrate" (bytes
+        actually downloaded per second of media, kbit/s).
+    """
+    state = {"buffer": 0.0, "throughputs": [], "quality": None}
+    clock = 0.0
+    startup_delay = None
+    rebuffer = 0.0
+    switches = 0
+    played = 0.0
+    nominal_bits = 0.0
+    delivered_bits = 0.0
+
+    segment_count = min(len(rung["segments"]) for rung in ladder)
+    for index in range(segment_count):
+        quality = algorithm(ladder, state)
+        if state["quality"] is not None and quality != state["quality"]:
+            switches += 1
+        state["quality"] = quality
+
+        seconds, size = ladder[quality]["segments"][index]
+        download_time = get_download_time(trace, clock, size)
+        clock += download_time
+
+        if startup_delay is not None:
+            if download_time > state["buffer"]:
+                rebuffer += download_time - state["buffer"]
+            state["buffer"] = max(0.0, state["buffer"] - download_time)
+        state["buffer"] += seconds
+        state["throughputs"].append(size * 8 / download_time)
+        played += seconds
+        nominal_bits += ladder[quality]["bandwidth"] * seconds
+        delivered_bits += size * 8
+
+        if startup_delay is None and (state["buffer"] >= startup_buffer or index == segment_count - 1):
+            startup_delay = clock
+
+        # A full buffer pauses downloading until there is room for the next segment
+        if state["buffer"] > max_buffer:
+            clock += state["buffer"] - max_buffer
+            state["buffer"] = max_buffer
+
+    return {
+        "startup_delay": startup_delay or 0.0,
+        "rebuffer_seconds": rebuffer,
+        "rebuffer_ratio": rebuffer / (played + rebuffer) if played else 0.0,
+        "switches": switches,
+        "average_bitrate": nominal_bits / played / 1000 if played else 0.0,
+        "delivered_bitrate": delivered_bits / played / 1000 if played else 0.0,
+    }
+
+
+def write_rows(rows: list, csv_path: str) -> None:
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep(mpd_paths: list, traces: dict, algorithms: list = None, csv_path: str = None) -> list:
+    """
+    Simulates every combination of manifest, video AdaptationSet, trace and ABR
+    algorithm. Use sweep_packaging to generate the manifests to compare.
+
+    Args:
+        mpd_paths (list of str): The manifests to compare.
+        traces (dict): Maps trace names to (duration, bits/s) periods.
+        algorithms (list of str): Names from abr_algorithms. Defaults to all of them.
+        csv_path (str): Optional CSV file the results are written to.
+
+    Returns:
+        list of dict: One row of simulate_playback results per combination.
+    """
+    if algorithms is None:
+        algorithms = list(abr_algorithms)
+
+    rows = []
+    for mpd_path in mpd_paths:
+        for codec, ladder in load_ladders(mpd_path).items():
+            for trace_name, trace in traces.items():
+                for algorithm in algorithms:
+                    row = {"mpd": mpd_path, "adaptation_set": codec, "trace": trace_name, "algorithm": algorithm}
+                    row.update(simulate_playback(ladder, trace, abr_algorithms[algorithm]))
+                    rows.append(row)
+
+    if csv_path is not None and rows:
+        write_rows(rows, csv_path)
+    return rows
+
+
+def sweep_packaging(mp4_dir: str, base_name: str, work_dir: str, traces: dict, seg_durations: list,
+                    ladders: dict = None, algorithms: list = None, csv_path: str = None) -> list:
+    """
+    Repackages a title's encoded MP4s into DASH once per segment duration and ladder,
+    without re-encoding, and simulates every variant. Segments can only start on a
+    keyframe, so durations below the GOP length of the MP4s come out at the GOP length.
+
+    Args:
+        mp4_dir (str): The directory holding the "{base_name}_{rendition}.mp4" files.
+        base_name (str): The title, e.g. "stickman-animation".
+        work_dir (str): Each variant is packaged into "{work_dir}/{ladder}-{seg_duration}s".
+        traces (dict): Maps trace names to (duration, bits/s) periods.
+        seg_durations (list of float): The segment durations to compare, in seconds.
+        ladders (dict): Maps a ladder name to the renditions it keeps, like
+            {"no-720p": ["1080p", "360p", "240p"]}. Defaults to every encoded rendition.
+        algorithms (list of str): Names from abr_algorithms. Defaults to all of them.
+        csv_path (str): Optional CSV file the results are written to.
+
+    Returns:
+        list of dict: The sweep rows, with the "ladder" and "seg_duration" of each variant.
+    """
+    prefix = f"{base_name}_"
+    renditions = {
+        os.path.splitext(os.path.basename(path))[0][len(prefix):]: path
+        for path in sorted(glob.glob(os.path.join(glob.escape(mp4_dir), f"{glob.escape(prefix)}*.mp4")))
+    }
+    if not renditions:
+        raise ValueError(f"No encoded MP4s of {base_name} in {mp4_dir}")
+    if ladders is None:
+        ladders = {"full": list(renditions)}
+    has_audio = probe_video(next(iter(renditions.values())))["has_audio"]
+
+    rows = []
+    for ladder_name, ladder in ladders.items():
+        missing = [rendition for rendition in ladder if rendition not in renditions]
+        if missing:
+            raise ValueError(f"Ladder {ladder_name} needs renditions that are not encoded: {missing}")
+
+        # One AdaptationSet per codec, named by the rendition suffix like "hevc" in "720p_hevc"
+        encoded_files = {}
+        for rendition in ladder:
+            encoded_files.setdefault(rendition.partition("_")[2], []).append(os.path.abspath(renditions[rendition]))
+
+        for seg_duration in seg_durations:
+            variant_dir = os.path.join(work_dir, f"{ladder_name}-{seg_duration:g}s")
+            if os.path.exists(variant_dir):
+                shutil.rmtree(variant_dir)
+            os.makedirs(variant_dir)
+            mpd_path = os.path.join(variant_dir, f"{base_name}_dash.mpd")
+            ffmpeg_cmd = build_ladder_command(encoded_files, os.path.abspath(mpd_path), has_audio, seg_duration)
+            subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+
+            for row in sweep([mpd_path], traces, algorithms):
+                rows.append({"ladder": ladder_name, "seg_duration": seg_duration, **row})
+
+    if csv_path is not None and rows:
+        write_rows(rows, csv_path)
+    return rows
+
+
+def print_results(rows: list) -> None:
+    print(f"{'startup':>8} {'rebuf%':>7} {'switch':>6} {'avg kbps':>9} {'dlv kbps':>9}  algorithm  trace  set  mpd")
+    for row in rows:
+        print(f"{row['startup_delay']:8.2f} {row['rebuffer_ratio'] * 100:7.2f} {row['switches']:6d} "
+              f"{row['average_bitrate']:9.0f} {row['delivered_bitrate']:9.0f}  "
+              f"{row['algorithm']}  {row['trace']}  {row['adaptation_set']}  {row['mpd']}")
+
+
+if __name__ == "__main__":
+    traces = {
+        "3g": synthetic_trace(1000, variability=0.5),
+        "4g": synthetic_trace(6000, variability=0.4),
+        "wifi": synthetic_trace(20000, variability=0.2),
+    }
+    # Recorded traces, one "<seconds> <kbit/s>" pair per line
+    for trace_path in sorted(glob.glob("../traces/*.txt")):
+        traces[os.path.splitext(os.path.basename(trace_path))[0]] = load_trace(trace_path)
+
+    # Repackage the MP4s written by scanning-encoder-script.py for every combination
+    results = sweep_packaging("../stickman-animation/stickman-animation_output/mp4", "stickman-animation",
+                              "../abr_variants", traces, seg_durations=[2, 4, 6],
+                              ladders={"full": ["1080p", "720p", "360p", "240p"], "no-720p": ["1080p", "360p", "240p"]},
+                              csv_path="abr_results.csv")
+    print_results(results)
@@ -0,0 +1,193 @@
+import copy
+import os
+import xml.etree.ElementTree as ET
+
+mpd_namespace = "urn:mpeg:dash:schema:mpd:2011"
+
+# Keep the default namespace unprefixed when manifests are written back
+ET.register_namespace("", mpd_namespace)
+ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+ET.register_namespace("xlink", "http://www.w3.org/1999/xlink")
+
+
+def mpd_tag(name: str) -> str:
+    return f"{{{mpd_namespace}}}{name}"
+
+
+def get_adaptation_set_key(adaptation_set) -> tuple:
+    """
+    Returns what identifies an AdaptationSet across manifests: its content type, plus
+    the codec family (e.g. "avc1") of its first Representation.
+
+    Args:
+        adaptation_set (xml.etree.ElementTree.Element): The AdaptationSet element.
+
+    Returns:
+        tuple: (content type, codec family).
+    """
+    content_type = adaptation_set.get("contentType") or adaptation_set.get("mimeType", "").split("/")[0]
+    representation = adaptation_set.find(mpd_tag("Representation"))
+    codecs = adaptation_set.get("codecs") or (representation.get("codecs", "") if representation is not None else "")
+    return content_type, codecs.split(".")[0]
+
+
+def localize_representations(adaptation_set, prefix: str) -> None:
+    """
+    Rewrites the Representations of an AdaptationSet from a manifest in the "{prefix}/"
+    subdirectory so they can be listed in a manifest one directory up. Ids become
+    "{prefix}_{id}", and $RepresentationID$ in each SegmentTemplate is resolved to the old
+    id, so the segment paths stay exactly the ones already on disk.
+
+    Args:
+        adaptation_set (xml.etree.ElementTree.Element): The AdaptationSet element.
+        prefix (str): The subdirectory the manifest lives in, e.g. "360p".
+    """
+    set_template = adaptation_set.find(mpd_tag("SegmentTemplate"))
+    if set_template is not None:
+        adaptation_set.remove(set_template)
+
+    for representation in adaptation_set.findall(mpd_tag("Representation")):
+        old_id = representation.get("id")
+        template = representation.find(mpd_tag("SegmentTemplate"))
+        if template is None and set_template is not None:
+            template = copy.deepcopy(set_template)
+            representation.append(template)
+
+        if template is not None:
+            for attribute in ("initialization", "media"):
+                if template.get(attribute) is not None:
+                    path = template.get(attribute).replace("$RepresentationID$", old_id)
+                    template.set(attribute, f"{prefix}/{path}")
+
+        representation.set("id", f"{prefix}_{old_id}")
+
+
+def build_dash_command(input_files: list, maps: list, manifest_path: str, seg_duration: float = 2,
+                       adaptation_sets: str = None) -> list:
+    """
+    Builds the ffmpeg command that packages already encoded MP4s into DASH without re-encoding.
+
+    Args:
+        input_files (list of str): The encoded MP4s.
+        maps (list of str): ffmpeg -map specifiers, e.g. ["0", "1:v"].
+        manifest_path (str): The absolute path of the manifest. Segments are written next to it.
+        seg_duration (float): Target segment duration in seconds.
+        adaptation_sets (str): Optional ffmpeg -adaptation_sets grouping, e.g. "id=0,streams=0,1 id=1,streams=a".
+
+    Returns:
+        list of str: The ffmpeg command.
+    """
+    ffmpeg_cmd = ["ffmpeg"]
+    for input_file in input_files:
+        ffmpeg_cmd += ["-i", input_file]
+    for stream_map in maps:
+        ffmpeg_cmd += ["-map", stream_map]
+    ffmpeg_cmd += [
+        "-c", "copy",
+        "-f", "dash",
+        "-use_timeline", "1",
+        "-use_template", "1",
+        "-seg_duration", str(seg_duration),
+        *(["-adaptation_sets", adaptation_sets] if adaptation_sets else []),
+        "-init_seg_name", "init-stream$RepresentationID$.m4s",
+        "-media_seg_name", "chunk-stream$RepresentationID$-$Number%05d$.m4s",
+        # Segments are written relative to the manifest, so no chdir is needed
+        manifest_path
+    ]
+    return ffmpeg_cmd
+
+
+def build_ladder_command(encoded_files: dict, manifest_path: str, has_audio: bool = True,
+                         seg_duration: float = 2) -> list:
+    """
+    Builds the ffmpeg command that packages a ladder into one manifest, with an
+    AdaptationSet per codec and one for the audio of the first file. The audio is
+    mapped first, so the Representation ids of the audio and of the first codec stay
+    the same when more codecs are added to the ladder later.
+
+    Args:
+        encoded_files (dict): Maps each codec to its encoded MP4s.
+        manifest_path (str): The absolute path of the manifest.
+        has_audio (bool): Whether the encoded files carry audio.
+        seg_duration (float): Target segment duration in seconds.
+
+    Returns:
+        list of str: The ffmpeg command.
+    """
+    input_files = []
+    maps = []
+    adaptation_sets = []
+    if has_audio:
+        maps.append("0:a:0")
+        adaptation_sets.append("id=0,streams=0")
+    for codec_files in encoded_files.values():
+        streams = range(len(maps), len(maps) + len(codec_files))
+        adaptation_sets.append(f"id={len(adaptation_sets)},streams={','.join(str(stream) for stream in streams)}")
+        maps += [f"{i}:v:0" for i in range(len(input_files), len(input_files) + len(codec_files))]
+        input_files += codec_files
+
+    return build_dash_command(input_files, maps, manifest_path, seg_duration, " ".join(adaptation_sets))
+
+
+def merge_manifests(manifests: list, output_path: str) -> None:
+    """
+    Combines single-rendition manifests, each in its own subdirectory of the output
+    manifest's directory, into one manifest. Representations are grouped into
+    AdaptationSets by content type and codec family. The first manifest provides the
+    MPD and Period attributes. The result is written atomically.
+
+    Args:
+        manifests (list of tuple): (subdirectory, manifest path) pairs, in the order the
+            Representations should be listed.
+        output_path (str): The path of the combined manifest.
+    """
+    merged_root = None
+    merged_period = None
+    adaptation_sets = {}
+
+    for prefix, manifest_path in manifests:
+        root = ET.parse(manifest_path).getroot()
+        period = root.find(mpd_tag("Period"))
+
+        if merged_root is None:
+            merged_root = root
+            merged_period = period
+            for adaptation_set in period.findall(mpd_tag("AdaptationSet")):
+                localize_representations(adaptation_set, prefix)
+                adaptation_sets.setdefault(get_adaptation_set_key(adaptation_set), adaptation_set)
+            continue
+
+        for adaptation_set in period.findall(mpd_tag("AdaptationSet")):
+            localize_representations(adaptation_set, prefix)
+            key = get_adaptation_set_key(adaptation_set)
+            target = adaptation_sets.get(key)
+
+            if target is None:
+                adaptation_set.set("id", str(len(merged_period.findall(mpd_tag("AdaptationSet")))))
+                merged_period.append(adaptation_set)
+                adaptation_sets[key] = adaptation_set
+                continue
+
+            for representation in adaptation_set.findall(mpd_tag("Representation")):
+                target.append(representation)
+            for attribute in ("maxWidth", "maxHeight"):
+                if target.get(attribute) is not None and adaptation_set.get(attribute) is not None:
+                    target.set(attribute, str(max(int(target.get(attribute)), int(adaptation_set.get(attribute)))))
+
+    write_manifest(ET.ElementTree(merged_root), output_path)
+
+
+def write_manifest(tree: ET.ElementTree, output_path: str) -> None:
+    """
+    Writes a manifest to a temporary file and renames it into place, so players
+    never fetch a partially written manifest.
+
+    Args:
+        tree (xml.etree.ElementTree.ElementTree): The manifest.
+        output_path (str): The path of the manifest.
+    """
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    tree.write(tmp_path, encoding="utf-8", xml_declaration=True)
+    with open(tmp_path, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(tmp_path, output_path)
@@ -0,0 +1,430 @@
+import json
+import os
+import shutil
+import socket
+import socketserver
+import tarfile
+import tempfile
+import threading
+import time
+from collections import deque
+
+from encoding_metrics import append_jsonl
+from segment_store import check_link_mode, store_tree
+
+# Seconds between worker heartbeats, and after which a silent worker's job is reassigned
+heartbeat_interval = 5
+heartbeat_timeout = 30
+# Attempts per job before it is reported as failed
+max_attempts = 3
+
+
+def send_message(sock: socket.socket, message: dict) -> None:
+    """
+    Sends one newline-delimited JSON message.
+
+    Args:
+        sock (socket.socket): A connected socket.
+        message (dict): The message to send.
+    """
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def read_message(rfile) -> dict:
+    """
+    Reads one newline-delimited JSON message.
+
+    Args:
+        rfile: A binary file object wrapping the socket.
+
+    Returns:
+        dict: The decoded message.
+    """
+    line = rfile.readline()
+    if not line:
+        raise ConnectionError("Connection closed before a message was received")
+    return json.loads(line)
+
+
+class LimitedReader:
+    """
+    Exposes the next `size` bytes of a stream as a file object, so an upload can be
+    extracted straight off the socket without buffering it.
+    """
+
+    def __init__(self, rfile, size: int):
+        self.rfile = rfile
+        self.remaining = size
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.rfile.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self) -> None:
+        while self.remaining and self.read(1024 * 1024):
+            pass
+
+
+class Coordinator(socketserver.ThreadingTCPServer):
+    """
+    Hands out one job per source video to workers that connect over TCP, and
+    reassigns jobs whose worker stopped sending heartbeats.
+
+    Every exchange is a single connection: the worker sends one JSON line and the
+    coordinator answers with one. A "result" message may be followed by a tar
+    stream of the job's output directory (upload mode).
+
+    In upload mode the coordinator also does the work that needs its filesystem: it
+    appends the spans workers send with their results to metrics_path, and moves
+    uploaded trees into segment_store.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, video_paths: list, args: list = None, kwargs: dict = None,
+                 mode: str = "shared"):
+        if mode not in ("shared", "upload"):
+            raise ValueError(f"Unknown result mode: {mode}")
+        if mode == "upload" and kwargs and kwargs.get("segment_store") is not None:
+            for video_path in video_paths:
+                check_link_mode(os.path.splitext(video_path)[0] + "_output", kwargs["segment_store"],
+                                kwargs.get("link_mode", "hardlink"))
+
+        super().__init__(address, CoordinatorHandler)
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.pending = deque()
+        self.jobs = {}
+
+        for job_id, video_path in enumerate(video_paths):
+            self.jobs[str(job_id)] = {
+                "video_path": video_path,
+                "output_dir": os.path.splitext(video_path)[0] + "_output",
+                "args": list(args or []),
+                "kwargs": dict(kwargs or {}),
+                "state": "pending",
+                "worker": None,
+                "last_heartbeat": 0.0,
+                "attempts": 0,
+                "error": None,
+            }
+            self.pending.append(str(job_id))
+
+        if not self.jobs:
+            self.finished.set()
+
+    def assign_job(self, worker: str) -> dict:
+        with self.lock:
+            if not self.pending:
+                return {"type": "shutdown" if self.finished.is_set() else "wait"}
+
+            job_id = self.pending.popleft()
+            job = self.jobs[job_id]
+            job.update(state="assigned", worker=worker, last_heartbeat=time.monotonic())
+            job["attempts"] += 1
+            kwargs = dict(job["kwargs"])
+            if self.mode == "upload":
+                # Remote workers cannot reach the store, the coordinator links uploaded trees into it
+                kwargs.pop("segment_store", None)
+            return {
+                "type": "job",
+                "job_id": job_id,
+                "video_path": job["video_path"],
+                "args": job["args"],
+                "kwargs": kwargs,
+                "mode": self.mode,
+            }
+
+    def record_heartbeat(self, worker: str, job_id: str) -> dict:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] not in ("assigned", "uploading") or job["worker"] != worker:
+                return {"type": "cancel"}
+            job["last_heartbeat"] = time.monotonic()
+            return {"type": "ok"}
+
+    def accept_result(self, worker: str, job_id: str) -> bool:
+        """
+        Returns True if this worker's result is the one that counts for the job, and
+        marks the job as uploading so it is not reassigned while its result is received.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] != "assigned" or job["worker"] != worker:
+                return False
+            job.update(state="uploading", last_heartbeat=time.monotonic())
+            return True
+
+    def finish_job(self, worker: str, job_id: str, error: str = None) -> None:
+        with self.lock:
+            job = self.jobs[job_id]
+            if job["state"] != "uploading" or job["worker"] != worker:
+                return
+            if error is not None and job["attempts"] < max_attempts:
+                job.update(state="pending", worker=None, error=error)
+                self.pending.append(job_id)
+            else:
+                job.update(state="done" if error is None else "failed", error=error)
+            self.check_finished()
+
+    def reassign_lost_jobs(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            for job_id, job in self.jobs.items():
+                if job["state"] == "assigned" and now - job["last_heartbeat"] > heartbeat_timeout:
+                    print(f"Worker {job['worker']} lost, reassigning {job['video_path']}")
+                    error = f"Worker {job['worker']} stopped sending heartbeats"
+                    if job["attempts"] < max_attempts:
+                        job.update(state="pending", worker=None, error=error)
+                        self.pending.append(job_id)
+                    else:
+                        job.update(state="failed", error=error)
+            self.check_finished()
+
+    def check_finished(self) -> None:
+        if all(job["state"] in ("done", "failed") for job in self.jobs.values()):
+            self.finished.set()
+
+    def record_spans(self, job_id: str, spans: list) -> None:
+        """Appends the spans a worker measured to the job's metrics_path, one writer for every worker."""
+        metrics_path = self.jobs[job_id]["kwargs"].get("metrics_path")
+        if metrics_path is None:
+            return
+        with self.lock:
+            for span in spans:
+                append_jsonl(metrics_path, span)
+
+    def store_upload(self, job_id: str, stream) -> None:
+        """
+        Extracts an uploaded output tree, swaps it in place of the job's output
+        directory, and links it into the segment store if the job uses one.
+        """
+        output_dir = self.jobs[job_id]["output_dir"]
+        parent_dir = os.path.dirname(os.path.abspath(output_dir))
+        staging_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".upload-")
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                archive.extractall(staging_dir, filter="data")
+
+            if os.path.exists(output_dir):
+                old_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".old-")
+                os.rename(output_dir, os.path.join(old_dir, "tree"))
+                os.rename(staging_dir, output_dir)
+                shutil.rmtree(old_dir)
+            else:
+                os.rename(staging_dir, output_dir)
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+
+        kwargs = self.jobs[job_id]["kwargs"]
+        if kwargs.get("segment_store") is not None:
+            store_tree(output_dir, kwargs["segment_store"], kwargs.get("link_mode", "hardlink"))
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    # A worker that stalls mid-upload fails the upload instead of holding the job forever
+    timeout = heartbeat_timeout
+
+    def handle(self):
+        coordinator = self.server
+        message = read_message(self.rfile)
+        message_type = message.get("type")
+        worker = message.get("worker")
+
+        if message_type == "request":
+            reply = coordinator.assign_job(worker)
+        elif message_type == "heartbeat":
+            reply = coordinator.record_heartbeat(worker, message["job_id"])
+        elif message_type == "result":
+            job_id = message["job_id"]
+            error = message.get("error")
+            upload = LimitedReader(self.rfile, message.get("upload_size", 0))
+            if coordinator.mode == "upload":
+                coordinator.record_spans(job_id, message.get("spans", []))
+
+            # A late result from a worker whose job was already reassigned is discarded
+            if not coordinator.accept_result(worker, job_id):
+                upload.drain()
+                reply = {"type": "ignored"}
+            else:
+                try:
+                    if error is None and upload.remaining:
+                        coordinator.store_upload(job_id, upload)
+                    upload.drain()
+                except (OSError, tarfile.TarError) as e:
+                    error = f"Upload failed: {e}"
+                finally:
+                    # Always leave the uploading state, or the job would never be reassigned
+                    coordinator.finish_job(worker, job_id, error)
+                reply = {"type": "ok"}
+        else:
+            reply = {"type": "error", "error": f"Unknown message type: {message_type}"}
+
+        send_message(self.connection, reply)
+
+
+def run_coordinator(video_paths: list, *args, host: str = "0.0.0.0", port: int = 8765,
+                    mode: str = "shared", **kwargs) -> dict:
+    """
+    Serves encode jobs to TCP workers until every video is encoded or has failed.
+
+    Args:
+        video_paths (list of str): The videos to encode. Workers must be able to read them.
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+        mode (str): "shared" if workers write results to a shared filesystem themselves,
+            "upload" if they stream each "{basename}_output" tree back to the coordinator.
+        *args, **kwargs: JSON-serialisable arguments passed on to the worker's job function.
+
+    Returns:
+        dict: Maps every video path to an error message, or None on success.
+    """
+    coordinator = Coordinator((host, port), video_paths, args, kwargs, mode)
+    server_thread = threading.Thread(target=coordinator.serve_forever, daemon=True)
+    server_thread.start()
+    print(f"Coordinator listening on {host}:{coordinator.server_address[1]} with {len(video_paths)} jobs")
+
+    try:
+        while not coordinator.finished.wait(heartbeat_interval):
+            coordinator.reassign_lost_jobs()
+        # Let idle workers pick up the shutdown message
+        time.sleep(heartbeat_interval)
+    finally:
+        coordinator.shutdown()
+        coordinator.server_close()
+
+    return {job["video_path"]: job["error"] if job["state"] == "failed" else None
+            for job in coordinator.jobs.values()}
+
+
+def exchange(address: tuple, message: dict, upload_path: str = None) -> dict:
+    """
+    Sends one message to the coordinator, optionally followed by a file, and returns the reply.
+
+    Args:
+        address (tuple): The (host, port) of the coordinator.
+        message (dict): The message to send.
+        upload_path (str): A file to stream after the message.
+
+    Returns:
+        dict: The coordinator's reply.
+    """
+    with socket.create_connection(address, timeout=heartbeat_timeout) as sock:
+        send_message(sock, message)
+        if upload_path is not None:
+            with open(upload_path, "rb") as file:
+                sock.sendfile(file)
+        # Uploads can take a while to extract on the other side
+        sock.settimeout(None)
+        with sock.makefile("rb") as rfile:
+            return read_message(rfile)
+
+
+def send_heartbeats(address: tuple, worker: str, job_id: str, stop: threading.Event,
+                    cancelled: threading.Event) -> None:
+    while not stop.wait(heartbeat_interval):
+        try:
+            if exchange(address, {"type": "heartbeat", "worker": worker, "job_id": job_id})["type"] == "cancel":
+                cancelled.set()
+        except OSError as e:
+            print(f"Heartbeat failed: {e}")
+
+
+def read_spans(metrics_path: str) -> list:
+    """Returns the spans of a job's JSON-lines metrics file, or an empty list if it has none."""
+    if not os.path.exists(metrics_path):
+        return []
+    with open(metrics_path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def run_worker(func, host: str, port: int = 8765, worker: str = None, scratch_dir: str = None,
+               connect_timeout: float = 60) -> None:
+    """
+    Requests jobs from a coordinator and runs func(video_path, *args, **kwargs) for each,
+    until the coordinator has no work left or cannot be reached for connect_timeout seconds.
+
+    In upload mode, the job runs with output_dir set to a directory under scratch_dir,
+    and the resulting tree is streamed back to the coordinator. Spans go to a
+    metrics_path in the job's directory and are sent along with the result, so
+    workers never write to the coordinator's metrics file.
+
+    Args:
+        func: The job function, e.g. encode_and_package.
+        host (str): The coordinator's address.
+        port (int): The coordinator's port.
+        worker (str): A unique worker name. Defaults to "{hostname}-{pid}".
+        scratch_dir (str): Where upload-mode outputs are built. Defaults to the system temp directory.
+        connect_timeout (float): Seconds to keep retrying an unreachable coordinator.
+    """
+    address = (host, port)
+    if worker is None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+
+    unreachable_since = None
+    while True:
+        try:
+            reply = exchange(address, {"type": "request", "worker": worker})
+            unreachable_since = None
+        except OSError as e:
+            unreachable_since = unreachable_since or time.monotonic()
+            if time.monotonic() - unreachable_since > connect_timeout:
+                print(f"Coordinator unreachable, stopping worker {worker}: {e}")
+                return
+            time.sleep(heartbeat_interval)
+            continue
+
+        if reply["type"] == "shutdown":
+            return
+        if reply["type"] != "job":
+            time.sleep(heartbeat_interval)
+            continue
+
+        job_id = reply["job_id"]
+        stop, cancelled = threading.Event(), threading.Event()
+        heartbeat_thread = threading.Thread(target=send_heartbeats,
+                                            args=(address, worker, job_id, stop, cancelled), daemon=True)
+        heartbeat_thread.start()
+
+        job_dir = tempfile.mkdtemp(dir=scratch_dir, prefix=f"job-{job_id}-")
+        try:
+            kwargs = dict(reply["kwargs"])
+            if reply["mode"] == "upload":
+                kwargs["output_dir"] = os.path.join(job_dir, "output")
+                if kwargs.get("metrics_path") is not None:
+                    kwargs["metrics_path"] = os.path.join(job_dir, "metrics.jsonl")
+
+            error = None
+            try:
+                func(reply["video_path"], *reply["args"], **kwargs)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+
+            if cancelled.is_set():
+                continue
+
+            result = {"type": "result", "worker": worker, "job_id": job_id, "error": error}
+            if reply["mode"] == "upload" and kwargs.get("metrics_path") is not None:
+                result["spans"] = read_spans(kwargs["metrics_path"])
+            upload_path = None
+            if error is None and reply["mode"] == "upload":
+                upload_path = os.path.join(job_dir, "output.tar")
+                with tarfile.open(upload_path, "w") as archive:
+                    archive.add(kwargs["output_dir"], arcname=".")
+                result["upload_size"] = os.path.getsize(upload_path)
+
+            # Heartbeats keep running while the tree is archived and uploaded
+            try:
+                exchange(address, result, upload_path)
+            except OSError as e:
+                # The coordinator reassigns the job once our heartbeats stop
+                print(f"Failed to report job {job_id}: {e}")
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+            shutil.rmtree(job_dir, ignore_errors=True)
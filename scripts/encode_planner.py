@@ -0,0 +1,172 @@
+import heapq
+import json
+import os
+import socket
+
+from video_ladder import filter_and_sort_qualities
+
+# Encode seconds per work unit (source pixel x frame x rendition) before this host has been measured
+default_seconds_per_unit = 2e-8
+# Weight of the newest run when updating the throughput model
+model_smoothing = 0.3
+# Frame rate assumed when ffprobe cannot report one
+default_fps = 30.0
+# Encode time of each codec relative to libx264 at the same resolution
+codec_cost_factors = {
+    "libx264": 1.0,
+    "libx265": 4.0,
+    "libsvtav1": 3.0,
+}
+
+
+def count_renditions(resolutions: list, video_height: int) -> int:
+    """
+    Returns how many of the given qualities a video of this height is encoded into,
+    following filter_and_sort_qualities.
+
+    Args:
+        resolutions (list of str): Qualities like ["720p", "360p"].
+        video_height (int): The height of the source video.
+
+    Returns:
+        int: The number of renditions, at least 1.
+    """
+    return len(filter_and_sort_qualities(resolutions, video_height))
+
+
+def estimate_work_units(cost: dict, resolutions: list, codecs: list = None) -> float:
+    """
+    Estimates the work of encoding a video as source pixels x frames x renditions,
+    with the renditions of slower codecs weighted by codec_cost_factors.
+
+    Args:
+        cost (dict): The video's estimate_job_cost result from load_scheduler.
+        resolutions (list of str): The requested qualities.
+        codecs (list of str): The encoders of the ladder. Defaults to ["libx264"].
+
+    Returns:
+        float: The work units, 0.0 if the video could not be probed.
+    """
+    codec_factor = sum(codec_cost_factors.get(codec, 1.0) for codec in codecs or ["libx264"])
+    frames = cost["duration"] * (cost["fps"] or default_fps)
+    return cost["pixels"] * frames * count_renditions(resolutions, cost["height"]) * codec_factor
+
+
+def load_model(model_path: str) -> dict:
+    """
+    Loads this host's throughput model.
+
+    Args:
+        model_path (str): The JSON file holding the models of all hosts.
+
+    Returns:
+        dict: The "seconds_per_unit" and the number of "runs" it was measured over.
+    """
+    models = {}
+    if os.path.exists(model_path):
+        with open(model_path) as file:
+            models = json.load(file)
+    return models.get(socket.gethostname(), {"seconds_per_unit": default_seconds_per_unit, "runs": 0})
+
+
+def update_model(model_path: str, observations: list) -> dict:
+    """
+    Folds the measured jobs of a run into this host's throughput model.
+
+    Args:
+        model_path (str): The JSON file holding the models of all hosts.
+        observations (list of tuple): (work units, elapsed seconds) of every finished job.
+
+    Returns:
+        dict: The updated model.
+    """
+    total_units = sum(units for units, _ in observations if units > 0)
+    total_seconds = sum(seconds for units, seconds in observations if units > 0)
+    model = load_model(model_path)
+    if total_units <= 0:
+        return model
+
+    measured = total_seconds / total_units
+    if model["runs"] == 0:
+        model["seconds_per_unit"] = measured
+    else:
+        model["seconds_per_unit"] = (1 - model_smoothing) * model["seconds_per_unit"] + model_smoothing * measured
+    model["runs"] += 1
+
+    models = {}
+    if os.path.exists(model_path):
+        with open(model_path) as file:
+            models = json.load(file)
+    models[socket.gethostname()] = model
+    with open(f"{model_path}.part", "w") as file:
+        json.dump(models, file, indent=2)
+    os.replace(f"{model_path}.part", model_path)
+    return model
+
+
+def plan_jobs(video_paths: list, resolutions: list, costs: dict, model: dict, cpu_count: int = None,
+              codecs: list = None) -> dict:
+    """
+    Orders jobs longest-processing-time-first and simulates how run_with_load_control
+    will run them: in that order, each starting as soon as the running jobs leave
+    enough of the cpu_count cores for its estimated "cpu" cost. A 1080p job claims
+    about 2 cores and a 4K job about 9, so the number of concurrent jobs varies.
+
+    Args:
+        video_paths (list of str): The videos to encode.
+        resolutions (list of str): The requested qualities.
+        costs (dict): estimate_job_cost results by video path.
+        model (dict): The throughput model from load_model.
+        cpu_count (int): The cores the scheduler packs jobs onto. Defaults to the CPU count.
+        codecs (list of str): The encoders of the ladder. Defaults to ["libx264"].
+
+    Returns:
+        dict: The LPT "order" of video paths, the per-job "work_units", "predicted"
+        seconds and simulated "start" seconds, the predicted "makespan", and the
+        "lower_bound" no schedule can beat.
+    """
+    if cpu_count is None:
+        cpu_count = os.cpu_count() or 1
+
+    work_units = {video_path: estimate_work_units(costs[video_path], resolutions, codecs)
+                  for video_path in video_paths}
+    predicted = {video_path: units * model["seconds_per_unit"] for video_path, units in work_units.items()}
+    order = sorted(video_paths, key=lambda video_path: predicted[video_path], reverse=True)
+
+    # (finish time, cores) of the simulated running jobs
+    running = []
+    used_cores = 0.0
+    clock = 0.0
+    start = {}
+    for video_path in order:
+        cores = costs[video_path]["cpu"]
+        while running and used_cores + cores > cpu_count:
+            clock, finished_cores = heapq.heappop(running)
+            used_cores -= finished_cores
+        start[video_path] = clock
+        heapq.heappush(running, (clock + predicted[video_path], cores))
+        used_cores += cores
+
+    core_seconds = sum(predicted[video_path] * costs[video_path]["cpu"] for video_path in video_paths)
+    return {
+        "order": order,
+        "work_units": work_units,
+        "predicted": predicted,
+        "start": start,
+        "makespan": max([finish for finish, _ in running] + [0.0]),
+        "lower_bound": max([core_seconds / cpu_count] + list(predicted.values())),
+    }
+
+
+def print_plan(plan: dict) -> None:
+    """
+    Prints the planned schedule and its predicted makespan.
+
+    Args:
+        plan (dict): The plan from plan_jobs.
+    """
+    for video_path in plan["order"]:
+        print(f"    starts at {plan['start'][video_path] / 60:8.1f} min, "
+              f"takes {plan['predicted'][video_path] / 60:8.1f} min  {video_path}")
+    print(f"Predicted makespan: {plan['makespan'] / 60:.1f} min "
+          f"(lower bound {plan['lower_bound'] / 60:.1f} min)")
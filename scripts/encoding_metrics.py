@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import re
+import resource
+import time
+from contextlib import contextmanager
+
+# Matches the progress field ffmpeg prints to stderr, e.g. "speed=2.35x"
+ffmpeg_speed_pattern = re.compile(r"speed=\s*([\d.]+)x")
+
+log_format = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def get_job_logger(log_path: str) -> logging.Logger:
+    """
+    Returns a logger that writes only to the given file. Unlike logging.basicConfig,
+    this works for every job in a batch, not just the first one.
+
+    Args:
+        log_path (str): The path to the job's log file.
+
+    Returns:
+        logging.Logger: The job logger. Release it with close_job_logger.
+    """
+    logger = logging.getLogger(f"encoding.{os.path.abspath(log_path)}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    if not logger.handlers:
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter(log_format))
+        logger.addHandler(handler)
+    return logger
+
+
+def close_job_logger(logger: logging.Logger) -> None:
+    """
+    Closes and detaches the handlers of a logger returned by get_job_logger.
+
+    Args:
+        logger (logging.Logger): The job logger.
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def parse_ffmpeg_speed(stderr) -> float:
+    """
+    Extracts the final speed factor from ffmpeg's stderr output.
+
+    Args:
+        stderr (str or bytes): The captured stderr of an ffmpeg run.
+
+    Returns:
+        float: The speed relative to real time, or None if ffmpeg did not report one.
+    """
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors="replace")
+    matches = ffmpeg_speed_pattern.findall(stderr or "")
+    return float(matches[-1]) if matches else None
+
+
+def get_path_size(path: str) -> int:
+    """
+    Returns the size of a file, or the total size of the files in a directory.
+
+    Args:
+        path (str): The path to a file or directory.
+
+    Returns:
+        int: The size in bytes, or 0 if the path does not exist.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def get_cpu_seconds() -> float:
+    """Returns the user and system CPU time used by this process and its waited-for children."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def append_jsonl(path: str, record: dict) -> None:
+    """
+    Appends one record to a JSON-lines file. Each record is written with a single
+    append, so concurrent jobs can share the file.
+
+    Args:
+        path (str): The path to the JSON-lines file.
+        record (dict): The record to append.
+    """
+    with open(path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def measure_stage(stage: str, job: str, logger: logging.Logger = None, metrics_path: str = None, **fields):
+    """
+    Times a stage of a job. The yielded span is a dict the caller can fill in
+    with "bytes_in", "bytes_out" and "speed" before the block ends.
+
+    On exit the span gets its wall "duration" and "cpu_seconds" (including ffmpeg
+    children), is logged, and is appended to metrics_path if given.
+
+    Args:
+        stage (str): The stage name, e.g. "probe", "encode", "package" or "copy".
+        job (str): The job name, e.g. the source basename.
+        logger (logging.Logger): The job logger.
+        metrics_path (str): An optional JSON-lines file collecting spans of every job.
+        **fields: Extra labels, e.g. resolution="720p".
+
+    Yields:
+        dict: The span being measured.
+    """
+    span = {"job": job, "stage": stage, **fields, "bytes_in": 0, "bytes_out": 0, "speed": None}
+    span["start"] = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = get_cpu_seconds()
+    try:
+        yield span
+        span["status"] = "ok"
+    except BaseException:
+        span["status"] = "error"
+        raise
+    finally:
+        span["duration"] = time.perf_counter() - wall_start
+        span["cpu_seconds"] = get_cpu_seconds() - cpu_start
+
+        if logger is not None:
+            labels = "".join(f" {key}={value}" for key, value in fields.items())
+            speed = "n/a" if span["speed"] is None else f"{span['speed']}x"
+            logger.info(f"Stage {stage}{labels} {span['status']} in {span['duration']:.2f}s "
+                        f"(cpu {span['cpu_seconds']:.2f}s, in {span['bytes_in']}B, out {span['bytes_out']}B, "
+                        f"speed {speed})")
+        if metrics_path is not None:
+            append_jsonl(metrics_path, span)
+
+
+def write_prometheus_textfile(metrics_path: str, prom_path: str) -> None:
+    """
+    Aggregates the spans of a JSON-lines file into the Prometheus text exposition
+    format, e.g. for the node_exporter textfile collector. The file is replaced atomically.
+
+    Args:
+        metrics_path (str): The JSON-lines file written by measure_stage.
+        prom_path (str): The .prom file to write.
+    """
+    totals = {}
+    with open(metrics_path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            span = json.loads(line)
+            stage = totals.setdefault(span["stage"], {
+                "count": 0, "errors": 0, "duration": 0.0, "cpu_seconds": 0.0,
+                "bytes_in": 0, "bytes_out": 0, "speed_sum": 0.0, "speed_count": 0,
+            })
+            stage["count"] += 1
+            stage["errors"] += span.get("status") == "error"
+            stage["duration"] += span["duration"]
+            stage["cpu_seconds"] += span["cpu_seconds"]
+            stage["bytes_in"] += span.get("bytes_in", 0)
+            stage["bytes_out"] += span.get("bytes_out", 0)
+            if span.get("speed") is not None:
+                stage["speed_sum"] += span["speed"]
+                stage["speed_count"] += 1
+
+    metrics = [
+        ("video_encoding_stage_duration_seconds_total", "counter", "Wall time spent in each stage.",
+         lambda s: s["duration"]),
+        ("video_encoding_stage_runs_total", "counter", "Number of stage runs.",
+         lambda s: s["count"]),
+        ("video_encoding_stage_errors_total", "counter", "Number of failed stage runs.",
+         lambda s: s["errors"]),
+        ("video_encoding_stage_cpu_seconds_total", "counter", "CPU time of each stage, including ffmpeg.",
+         lambda s: s["cpu_seconds"]),
+        ("video_encoding_stage_bytes_in_total", "counter", "Bytes read by each stage.",
+         lambda s: s["bytes_in"]),
+        ("video_encoding_stage_bytes_out_total", "counter", "Bytes written by each stage.",
+         lambda s: s["bytes_out"]),
+        ("video_encoding_stage_ffmpeg_speed", "gauge", "Mean ffmpeg speed factor relative to real time.",
+         lambda s: s["speed_sum"] / s["speed_count"] if s["speed_count"] else None),
+    ]
+
+    lines = []
+    for name, metric_type, help_text, value_of in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for stage, stage_totals in sorted(totals.items()):
+            value = value_of(stage_totals)
+            if value is not None:
+                lines.append(f'{name}{{stage="{stage}"}} {value}')
+
+    tmp_path = f"{prom_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, prom_path)
@@ -0,0 +1,272 @@
+import csv
+import glob
+import os
+import subprocess
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from tqdm import tqdm
+
+from video_ladder import filter_and_sort_qualities, standard_resolutions
+from video_probe import probe_media_details
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = pq = None
+
+video_extensions = {".mp4", ".m4v", ".mkv", ".mov", ".webm", ".avi", ".ts"}
+
+# Columns of the inventory, in output order
+inventory_fields = [
+    "path", "size", "duration", "bitrate", "codec", "profile", "pix_fmt", "width", "height", "fps",
+    "video_bitrate", "has_b_frames", "audio_codec", "keyframe_interval", "max_keyframe_interval", "error",
+]
+# Rows written per CSV flush or Parquet part file
+batch_size = 1000
+
+
+def iter_video_files(library_dir: str):
+    """
+    Yields the video files under a directory, walking it lazily so huge libraries
+    are never listed in memory at once. Like find_mp4_files, directories ending with
+    "_output" are skipped, and so are hidden ones such as .staging, so renditions and
+    in-progress chunks are never counted as sources.
+
+    Args:
+        library_dir (str): The root of the library.
+
+    Yields:
+        str: The path of each video file.
+    """
+    directories = [library_dir]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError as e:
+            print(f"Error listing directory: {e}")
+            continue
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.endswith("_output") and not entry.name.startswith("."):
+                    directories.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in video_extensions:
+                yield entry.path
+
+
+def probe_row(video_path: str) -> dict:
+    """
+    Probes one file into an inventory row. Failures are recorded in the "error" column
+    instead of being raised, so one corrupt file does not stop the sweep.
+    """
+    row = dict.fromkeys(inventory_fields)
+    row["path"] = video_path
+    try:
+        row.update(probe_media_details(video_path))
+    except subprocess.CalledProcessError as e:
+        row["error"] = (e.stderr or "").strip() or f"ffprobe exited with status {e.returncode}"
+    except (OSError, ValueError, KeyError) as e:
+        row["error"] = str(e) or type(e).__name__
+    if row["error"]:
+        # One row per line, so truncate_torn_row can find the last complete one
+        row["error"] = " ".join(row["error"].split())
+    return row
+
+
+def truncate_torn_row(csv_path: str) -> None:
+    """
+    Drops the partial last line a crash in the middle of a write can leave in a CSV
+    inventory, so appended rows never merge into it.
+
+    Args:
+        csv_path (str): The CSV file.
+    """
+    with open(csv_path, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk_start = max(0, position - 65536)
+            file.seek(chunk_start)
+            newline = file.read(position - chunk_start).rfind(b"\n")
+            if newline != -1:
+                position = chunk_start + newline + 1
+                break
+            position = chunk_start
+        if position < end:
+            file.truncate(position)
+
+
+def read_inventory_column(output_path: str, column: str):
+    """
+    Yields one column of an existing inventory, reading a CSV row by row or a Parquet
+    directory part by part.
+
+    Args:
+        output_path (str): The CSV file or Parquet directory.
+        column (str): The column to read.
+
+    Yields:
+        The values of the column.
+    """
+    if output_path.endswith(".parquet"):
+        for part_path in sorted(glob.glob(os.path.join(output_path, "part-*.parquet"))):
+            yield from pq.read_table(part_path, columns=[column]).column(column).to_pylist()
+    elif os.path.exists(output_path):
+        with open(output_path, newline="") as file:
+            for row in csv.DictReader(file):
+                yield row[column]
+
+
+def get_parquet_schema():
+    return pa.schema([
+        ("path", pa.string()), ("size", pa.int64()), ("duration", pa.float64()), ("bitrate", pa.int64()),
+        ("codec", pa.string()), ("profile", pa.string()), ("pix_fmt", pa.string()), ("width", pa.int64()),
+        ("height", pa.int64()), ("fps", pa.float64()), ("video_bitrate", pa.int64()), ("has_b_frames", pa.bool_()),
+        ("audio_codec", pa.string()), ("keyframe_interval", pa.float64()),
+        ("max_keyframe_interval", pa.float64()), ("error", pa.string()),
+    ])
+
+
+def build_inventory(library_dir: str, output_path: str, max_workers: int = None,
+                    max_in_flight: int = None) -> int:
+    """
+    Probes every video in a library through a process pool and streams the rows to
+    a CSV file, or to a directory of Parquet part files if output_path ends with
+    ".parquet" (requires pyarrow). At most max_in_flight probes are queued at a time,
+    and rows are written in batches of batch_size. Files already in the output are
+    skipped, so an interrupted sweep resumes where it stopped; delete a row to probe
+    its file again.
+
+    Args:
+        library_dir (str): The root of the library.
+        output_path (str): The CSV file or Parquet directory to write.
+        max_workers (int): Number of probe processes. Defaults to the CPU count.
+        max_in_flight (int): Upper bound on queued probes. Defaults to 4 per worker.
+
+    Returns:
+        int: The number of files probed in this run.
+    """
+    parquet = output_path.endswith(".parquet")
+    if parquet and pa is None:
+        raise ImportError("Writing Parquet requires pyarrow, use a .csv output instead")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = max_workers * 4
+
+    if not parquet and os.path.exists(output_path):
+        # Before reading the done paths, so a file whose row was torn is probed again
+        truncate_torn_row(output_path)
+    done_paths = set(read_inventory_column(output_path, "path"))
+    if parquet:
+        os.makedirs(output_path, exist_ok=True)
+        part_index = len(glob.glob(os.path.join(output_path, "part-*.parquet")))
+    else:
+        new_file = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        csv_file = open(output_path, "a", newline="")
+        writer = csv.DictWriter(csv_file, fieldnames=inventory_fields)
+        if new_file:
+            writer.writeheader()
+
+    batch = []
+    probed = 0
+
+    def flush():
+        nonlocal part_index
+        if not batch:
+            return
+        if parquet:
+            # Each part is complete once renamed, so a crash never leaves a torn part behind
+            part_path = os.path.join(output_path, f"part-{part_index:05d}.parquet")
+            pq.write_table(pa.Table.from_pylist(batch, schema=get_parquet_schema()), f"{part_path}.tmp")
+            os.replace(f"{part_path}.tmp", part_path)
+            part_index += 1
+        else:
+            writer.writerows(batch)
+            csv_file.flush()
+            os.fsync(csv_file.fileno())
+        batch.clear()
+
+    try:
+        pending_paths = (path for path in iter_video_files(library_dir) if path not in done_paths)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+                tqdm(desc="Probing", unit="files", initial=len(done_paths)) as progress:
+            running = set()
+            exhausted = False
+            while running or not exhausted:
+                while not exhausted and len(running) < max_in_flight:
+                    video_path = next(pending_paths, None)
+                    if video_path is None:
+                        exhausted = True
+                    else:
+                        running.add(executor.submit(probe_row, video_path))
+
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch.append(future.result())
+                    probed += 1
+                    progress.update(1)
+                if len(batch) >= batch_size:
+                    flush()
+        flush()
+    finally:
+        if not parquet:
+            csv_file.close()
+
+    return probed
+
+
+def summarize_inventory(output_path: str, resolutions: list = None) -> dict:
+    """
+    Streams an inventory and counts which rungs of the ladder each file would be
+    encoded into, following filter_and_sort_qualities.
+
+    Args:
+        output_path (str): The CSV file or Parquet directory.
+        resolutions (list of str): The ladder. Defaults to standard_resolutions.
+
+    Returns:
+        dict: "files" and "errors" counts, a Counter of "ladders" (tuple of rungs -> files),
+        a Counter of files per "rung", and a Counter of files per video "codec".
+    """
+    if resolutions is None:
+        resolutions = standard_resolutions
+
+    summary = {"files": 0, "errors": 0, "ladders": Counter(), "rungs": Counter(), "codecs": Counter()}
+    heights = read_inventory_column(output_path, "height")
+    codecs = read_inventory_column(output_path, "codec")
+    errors = read_inventory_column(output_path, "error")
+    for height, codec, error in zip(heights, codecs, errors):
+        summary["files"] += 1
+        if error:
+            summary["errors"] += 1
+            continue
+        rungs = tuple(filter_and_sort_qualities(resolutions, int(height)))
+        summary["ladders"][rungs] += 1
+        summary["rungs"].update(rungs)
+        summary["codecs"][codec] += 1
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{summary['files']} files, {summary['errors']} could not be probed")
+    print("Files per rung:")
+    for rung in sorted(summary["rungs"], key=lambda q: int(q[:-1]), reverse=True):
+        print(f"    {rung:>6}: {summary['rungs'][rung]}")
+    print("Files per ladder:")
+    for rungs, count in summary["ladders"].most_common():
+        print(f"    {count:>8}  {', '.join(rungs)}")
+    print("Files per codec:")
+    for codec, count in summary["codecs"].most_common():
+        print(f"    {count:>8}  {codec}")
+
+
+if __name__ == "__main__":
+    library_dir = "../stickman-animation"
+    # Use a path ending with ".parquet" to write Parquet part files instead (needs pyarrow)
+    inventory_path = "../stickman-animation/inventory.csv"
+
+    probed_count = build_inventory(library_dir, inventory_path)
+    print(f"Probed {probed_count} new files")
+    print_summary(summarize_inventory(inventory_path))
@@ -0,0 +1,238 @@
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from tqdm import tqdm
+
+from video_probe import probe_video
+
+# Highest PSI "some avg10" percentage at which new jobs are still admitted
+pressure_limits = {
+    "cpu": 40.0,
+    "memory": 10.0,
+    "io": 40.0,
+}
+# Highest 1-minute load average per CPU at which new jobs are still admitted
+max_load_per_cpu = 1.5
+# Memory kept free for the rest of the host
+memory_reserve = 512 * 1024 * 1024
+# Rough ffmpeg/libx264 footprint: a fixed base plus buffers and lookahead per source pixel
+memory_base = 256 * 1024 * 1024
+memory_per_pixel = 400
+# Source pixels one core can decode, scale and encode without becoming the bottleneck
+pixels_per_core = 1280 * 720
+# Jobs started this recently have not reached their peak memory use yet
+ramp_up_seconds = 30
+# Mount point of the cgroup v2 hierarchy
+cgroup_root = "/sys/fs/cgroup"
+
+
+def estimate_job_cost(video_path: str) -> dict:
+    """
+    Estimates the resources an encode_and_package job will need from its probed source.
+
+    Args:
+        video_path (str): The path to the source video.
+
+    Returns:
+        dict: The estimated "cpu" (cores) and "memory" (bytes), plus the probed
+        "pixels" per frame, "height", "fps" and "duration" in seconds.
+    """
+    try:
+        info = probe_video(video_path)
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+        print(f"Error probing {video_path}: {e}")
+        info = {"width": 1280, "height": 720, "fps": 0.0, "duration": 0.0}
+
+    pixels = info["width"] * info["height"]
+    return {
+        "cpu": min(os.cpu_count() or 1, max(1.0, pixels / pixels_per_core)),
+        "memory": memory_base + pixels * memory_per_pixel,
+        "pixels": pixels,
+        "height": info["height"],
+        "fps": info["fps"],
+        "duration": info["duration"],
+    }
+
+
+def read_pressure(resource: str) -> float:
+    """
+    Reads the "some avg10" stall percentage from /proc/pressure (PSI).
+
+    Args:
+        resource (str): One of "cpu", "memory" or "io".
+
+    Returns:
+        float: The percentage of time some tasks stalled on the resource, or 0.0 if PSI is unavailable.
+    """
+    try:
+        with open(f"/proc/pressure/{resource}") as file:
+            for line in file:
+                if line.startswith("some"):
+                    fields = dict(field.split("=") for field in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0.0
+
+
+def get_cgroup_dir() -> str:
+    """
+    Returns the cgroup v2 directory of this process, from /proc/self/cgroup. Outside
+    a cgroup namespace this is a subdirectory of the mount, e.g. a systemd slice.
+
+    Returns:
+        str: The directory, or cgroup_root if it cannot be resolved.
+    """
+    try:
+        with open("/proc/self/cgroup") as file:
+            for line in file:
+                hierarchy, _, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0":
+                    cgroup_dir = os.path.normpath(os.path.join(cgroup_root, path.lstrip("/")))
+                    if (cgroup_dir == cgroup_root or cgroup_dir.startswith(cgroup_root + os.sep)) and os.path.isdir(cgroup_dir):
+                        return cgroup_dir
+    except (OSError, ValueError):
+        pass
+    return cgroup_root
+
+
+def read_available_memory() -> int:
+    """
+    Returns the memory available to this process: the smaller of the host's
+    MemAvailable and the headroom left under the cgroup v2 memory limits of its
+    cgroup and every ancestor.
+
+    Returns:
+        int: Available memory in bytes.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+
+    # A limit on any ancestor, e.g. the MemoryMax of a systemd slice, applies as well
+    cgroup_dir = get_cgroup_dir()
+    while True:
+        try:
+            with open(os.path.join(cgroup_dir, "memory.max")) as file:
+                limit = file.read().strip()
+            with open(os.path.join(cgroup_dir, "memory.current")) as file:
+                current = int(file.read().strip())
+            if limit != "max":
+                headroom = int(limit) - current
+                available = headroom if available is None else min(available, headroom)
+        except (OSError, ValueError):
+            pass
+        if cgroup_dir == cgroup_root:
+            break
+        cgroup_dir = os.path.dirname(cgroup_dir)
+
+    if available is None:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return available
+
+
+def has_headroom(cost: dict, running: list) -> bool:
+    """
+    Decides whether a job fits on the host next to the running jobs.
+
+    Args:
+        cost (dict): The estimated cost of the candidate job.
+        running (list of tuple): (cost, start time) of every running job.
+
+    Returns:
+        bool: True if the job can be admitted now.
+    """
+    # Always keep at least one job running, however large
+    if not running:
+        return True
+
+    cpu_count = os.cpu_count() or 1
+    if sum(job_cost["cpu"] for job_cost, _ in running) + cost["cpu"] > cpu_count:
+        return False
+
+    # MemAvailable does not reflect jobs that are still ramping up yet
+    now = time.monotonic()
+    ramping = sum(job_cost["memory"] for job_cost, started in running if now - started < ramp_up_seconds)
+    if read_available_memory() - memory_reserve - ramping < cost["memory"]:
+        return False
+
+    for resource, limit in pressure_limits.items():
+        if read_pressure(resource) > limit:
+            return False
+
+    return os.getloadavg()[0] <= cpu_count * max_load_per_cpu
+
+
+def lower_priority(niceness: int = 10, idle_io: bool = True) -> None:
+    """
+    Lowers the CPU and I/O priority of the current process. ffmpeg processes
+    started afterwards inherit both.
+
+    Args:
+        niceness (int): Increment passed to os.nice.
+        idle_io (bool): If True, move the process to the idle I/O class with ionice.
+    """
+    if niceness:
+        os.nice(niceness)
+    if idle_io and shutil.which("ionice"):
+        subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], capture_output=True)
+
+
+def run_with_load_control(func, video_paths: list, *args, max_workers: int = None, niceness: int = 10,
+                          idle_io: bool = True, poll_interval: float = 5.0, durations: dict = None,
+                          costs: dict = None, **kwargs) -> dict:
+    """
+    Runs func(video_path, *args, **kwargs) for every video in background worker processes,
+    starting a job only while the host has CPU, memory and I/O headroom for it.
+
+    Args:
+        func: The job function, e.g. encode_and_package.
+        video_paths (list of str): The videos to process, in submission order.
+        max_workers (int): Upper bound on concurrent jobs. Defaults to the CPU count.
+        niceness (int): Niceness increment applied to the workers.
+        idle_io (bool): If True, run the workers in the idle I/O class.
+        poll_interval (float): Seconds between admission checks while jobs are waiting.
+        durations (dict): If given, filled with the wall-clock seconds of every finished job.
+        costs (dict): estimate_job_cost results by video path, to avoid probing the videos again.
+
+    Returns:
+        dict: Maps every video path to the exception it raised, or None on success.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if costs is None:
+        costs = {}
+    pending = [(video_path, costs.get(video_path) or estimate_job_cost(video_path)) for video_path in video_paths]
+    pending.reverse()
+    running = {}
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=lower_priority,
+                             initargs=(niceness, idle_io)) as executor, \
+            tqdm(total=len(pending), desc="Video encoding") as progress:
+        while pending or running:
+            while pending and len(running) < max_workers and has_headroom(pending[-1][1], list(running.values())):
+                video_path, cost = pending.pop()
+                future = executor.submit(func, video_path, *args, **kwargs)
+                future.video_path = video_path
+                running[future] = (cost, time.monotonic())
+
+            done, _ = wait(list(running), timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, started = running.pop(future)
+                if durations is not None:
+                    durations[future.video_path] = time.monotonic() - started
+                results[future.video_path] = future.exception()
+                progress.update(1)
+
+    return results
@@ -0,0 +1,133 @@
+import math
+import re
+import xml.etree.ElementTree as ET
+from typing import Dict
+
+# Matches $Identifier$ or $Identifier%0Nd$ in a SegmentTemplate
+template_pattern = re.compile(r"\$(RepresentationID|Number|Time|Bandwidth)(%0(\d+)d)?\$")
+
+
+def parse_duration(duration: str) -> float:
+    """
+    Converts an ISO 8601 duration like "PT634.566S" or "PT1H2M3S" into seconds.
+
+    Args:
+        duration (str): The MPD duration attribute.
+
+    Returns:
+        float: The duration in seconds.
+    """
+    match = re.fullmatch(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?", duration)
+    if match is None:
+        raise ValueError(f"Unsupported duration: {duration}")
+    days, hours, minutes, seconds = (float(value) if value else 0.0 for value in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def fill_template(template: str, representation_id: str, number: int = 0, time: int = 0,
+                  bandwidth: int = 0) -> str:
+    """
+    Substitutes the identifiers of a DASH SegmentTemplate.
+
+    Args:
+        template (str): The template, e.g. "$RepresentationID$/$RepresentationID$_$Number$.m4v".
+        representation_id (str): The Representation id.
+        number (int): The segment number.
+        time (int): The segment start time in timescale units.
+        bandwidth (int): The Representation bandwidth.
+
+    Returns:
+        str: The segment path relative to the MPD.
+    """
+    values = {"RepresentationID": representation_id, "Number": number, "Time": time, "Bandwidth": bandwidth}
+
+    def substitute(match):
+        value = values[match.group(1)]
+        if match.group(3) is not None:
+            return f"{int(value):0{int(match.group(3))}d}"
+        return str(value)
+
+    return template_pattern.sub(substitute, template)
+
+
+def strip_namespace(tag: str) -> str:
+    return tag.split("}", 1)[-1]
+
+
+def find_child(element, name: str):
+    for child in element:
+        if strip_namespace(child.tag) == name:
+            return child
+    return None
+
+
+def parse_mpd_segments(mpd_path: str) -> Dict[str, dict]:
+    """
+    Lists the init and media segments of every Representation of a static MPD, in
+    playback order. Supports number-based SegmentTemplates with or without a SegmentTimeline.
+
+    Args:
+        mpd_path (str): The path to the MPD file.
+
+    Returns:
+        dict: Maps each Representation id to its "content_type", "adaptation_set" (the
+        AdaptationSet id, or "{period}.{index}" without one), "codecs", "bandwidth"
+        (bits/s), "height", "init" segment path, list of "media" segment paths relative
+        to the MPD, and the matching list of "durations" in seconds.
+    """
+    root = ET.parse(mpd_path).getroot()
+    total_duration = parse_duration(root.get("mediaPresentationDuration", "PT0S"))
+    representations = {}
+
+    periods = [period for period in root if strip_namespace(period.tag) == "Period"]
+    for period_index, period in enumerate(periods):
+        adaptation_sets = [element for element in period if strip_namespace(element.tag) == "AdaptationSet"]
+        for set_index, adaptation_set in enumerate(adaptation_sets):
+            set_id = adaptation_set.get("id") or f"{period_index}.{set_index}"
+            content_type = adaptation_set.get("contentType") or adaptation_set.get("mimeType", "").split("/")[0]
+            set_template = find_child(adaptation_set, "SegmentTemplate")
+
+            for representation in adaptation_set:
+                if strip_namespace(representation.tag) != "Representation":
+                    continue
+                template = find_child(representation, "SegmentTemplate")
+                if template is None:
+                    template = set_template
+                if template is None:
+                    raise ValueError(f"Representation {representation.get('id')} has no SegmentTemplate")
+
+                representation_id = representation.get("id")
+                bandwidth = int(representation.get("bandwidth", 0))
+                timescale = int(template.get("timescale", 1))
+                start_number = int(template.get("startNumber", 1))
+                timeline = find_child(template, "SegmentTimeline")
+
+                # (number, time, duration) of every media segment, in timescale units
+                segments = []
+                if timeline is not None:
+                    number, time = start_number, 0
+                    for entry in timeline:
+                        time = int(entry.get("t", time))
+                        for _ in range(int(entry.get("r", 0)) + 1):
+                            segments.append((number, time, int(entry.get("d"))))
+                            number += 1
+                            time += int(entry.get("d"))
+                else:
+                    duration = int(template.get("duration"))
+                    count = math.ceil(total_duration * timescale / duration)
+                    segments = [(start_number + i, i * duration, duration) for i in range(count)]
+
+                representations[representation_id] = {
+                    "content_type": (representation.get("mimeType", "").split("/")[0] or content_type),
+                    "adaptation_set": set_id,
+                    "codecs": representation.get("codecs") or adaptation_set.get("codecs", ""),
+                    "bandwidth": bandwidth,
+                    "height": int(representation.get("height", 0)),
+                    "init": fill_template(template.get("initialization"), representation_id,
+                                          bandwidth=bandwidth),
+                    "media": [fill_template(template.get("media"), representation_id, number, time, bandwidth)
+                              for number, time, _ in segments],
+                    "durations": [duration / timescale for _, _, duration in segments],
+                }
+
+    return representations
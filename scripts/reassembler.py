@@ -0,0 +1,165 @@
+import os
+import subprocess
+from typing import List
+
+from tqdm import tqdm
+
+from mpd_parser import parse_mpd_segments
+
+# Upper bound on a single copy_file_range/sendfile call
+copy_chunk_size = 64 * 1024 * 1024
+
+
+def copy_file_into(src_path: str, dst_fd: int) -> int:
+    """
+    Appends a file to an open file descriptor without copying it through userspace,
+    using copy_file_range, then sendfile, then a bounded read/write loop as fallbacks.
+
+    Args:
+        src_path (str): The file to append.
+        dst_fd (int): A file descriptor opened for writing.
+
+    Returns:
+        int: The number of bytes copied.
+    """
+    size = os.path.getsize(src_path)
+    copied = 0
+    with open(src_path, "rb") as src:
+        src_fd = src.fileno()
+        method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+
+        while copied < size:
+            count = min(copy_chunk_size, size - copied)
+            try:
+                if method == "copy_file_range":
+                    written = os.copy_file_range(src_fd, dst_fd, count)
+                elif method == "sendfile":
+                    written = os.sendfile(dst_fd, src_fd, None, count)
+                else:
+                    written = os.write(dst_fd, src.read(min(count, 1024 * 1024)))
+            except OSError:
+                # Not supported across these filesystems or file types, try the next method
+                if method == "read":
+                    raise
+                method = "sendfile" if method == "copy_file_range" else "read"
+                continue
+
+            if written == 0:
+                raise IOError(f"{src_path} shrank while being copied")
+            copied += written
+
+    return copied
+
+
+def reassemble_representation(mpd_path: str, representation_id: str, output_file: str,
+                              segment_dir: str = None) -> int:
+    """
+    Joins the init segment and the media segments of one Representation, in manifest
+    order, into a single fragmented MP4. The result is written to a temporary file,
+    checked against the segment sizes, and renamed into place.
+
+    Args:
+        mpd_path (str): The path to the MPD file.
+        representation_id (str): The id of the Representation to join.
+        output_file (str): The path of the MP4 to write.
+        segment_dir (str): The directory segment paths are relative to. Defaults to the MPD's directory.
+
+    Returns:
+        int: The size of the output file in bytes.
+    """
+    if segment_dir is None:
+        segment_dir = os.path.dirname(os.path.abspath(mpd_path))
+
+    representation = parse_mpd_segments(mpd_path)[representation_id]
+    segment_paths = [os.path.join(segment_dir, path) for path in [representation["init"]] + representation["media"]]
+
+    missing = [path for path in segment_paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} segments of {representation_id} are missing, e.g. {missing[0]}")
+
+    expected_size = sum(os.path.getsize(path) for path in segment_paths)
+    part_file = f"{output_file}.part"
+    fd = os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = 0
+        for segment_path in tqdm(segment_paths, desc=f"Reassembling {representation_id}", unit="segments"):
+            written += copy_file_into(segment_path, fd)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if written != expected_size or os.path.getsize(part_file) != expected_size:
+        os.remove(part_file)
+        raise IOError(f"Reassembled {representation_id} has {written} bytes, expected {expected_size}")
+
+    os.replace(part_file, output_file)
+    return expected_size
+
+
+def remux_audio_video(video_file: str, audio_file: str, output_file: str) -> None:
+    """
+    Muxes a video and an audio file into one MP4 without re-encoding.
+
+    Args:
+        video_file (str): The reassembled video Representation.
+        audio_file (str): The reassembled audio Representation.
+        output_file (str): The path of the MP4 to write.
+    """
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-i", video_file,
+        "-i", audio_file,
+        "-map", "0:v",
+        "-map", "1:a",
+        "-c", "copy",
+        "-f", "mp4",
+        "-y", f"{output_file}.part"
+    ]
+    subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+    os.replace(f"{output_file}.part", output_file)
+
+
+def reassemble_downloads(mpd_path: str, segment_dir: str, output_dir: str,
+                         representation_ids: List[str] = None, remux: bool = True) -> List[str]:
+    """
+    Reassembles every downloaded Representation of an MPD and, optionally, muxes
+    each video Representation with the first audio Representation.
+
+    Args:
+        mpd_path (str): The path to the MPD file.
+        segment_dir (str): The directory the segment paths are relative to.
+        output_dir (str): Where the MP4s are written.
+        representation_ids (list of str): Representations to reassemble. Defaults to the
+            ones whose init segment has been downloaded.
+        remux (bool): If True, also write "{video_id}+{audio_id}.mp4" for every video Representation.
+
+    Returns:
+        List[str]: The paths of the written files.
+    """
+    representations = parse_mpd_segments(mpd_path)
+    if representation_ids is None:
+        representation_ids = [representation_id for representation_id, representation in representations.items()
+                              if os.path.isfile(os.path.join(segment_dir, representation["init"]))]
+
+    os.makedirs(output_dir, exist_ok=True)
+    reassembled = {}
+    for representation_id in representation_ids:
+        output_file = os.path.join(output_dir, f"{representation_id}.mp4")
+        reassemble_representation(mpd_path, representation_id, output_file, segment_dir)
+        reassembled[representation_id] = output_file
+
+    written = list(reassembled.values())
+    if remux:
+        audio_ids = [i for i in reassembled if representations[i]["content_type"] == "audio"]
+        video_ids = [i for i in reassembled if representations[i]["content_type"] == "video"]
+        for video_id in video_ids if audio_ids else []:
+            output_file = os.path.join(output_dir, f"{video_id}+{audio_ids[0]}.mp4")
+            remux_audio_video(reassembled[video_id], reassembled[audio_ids[0]], output_file)
+            written.append(output_file)
+
+    return written
+
+
+if __name__ == "__main__":
+    for path in reassemble_downloads("../bbb_30fps.mpd", "../downloads/bbb_30fps", "../reassembled"):
+        print(path)
@@ -1,11 +1,21 @@
+import ctypes
+import errno
+import hashlib
 import os
 import subprocess
-import logging
-from json import loads as j_loads
+import shutil
+from json import dumps as j_dumps, loads as j_loads
 from pathlib import Path
 
-from tqdm import tqdm
-import shutil
+from dash_manifest import build_dash_command, build_ladder_command, merge_manifests
+from distributed_encoding import run_coordinator, run_worker
+from encode_planner import load_model, plan_jobs, print_plan, update_model
+from encoding_metrics import (close_job_logger, get_job_logger, get_path_size, measure_stage,
+                              parse_ffmpeg_speed, write_prometheus_textfile)
+from load_scheduler import estimate_job_cost, run_with_load_control
+from segment_store import check_link_mode, store_tree
+from video_ladder import filter_and_sort_qualities, standard_resolutions
+from video_probe import probe_video
 
 # Bitrate lookup table for different resolutions
 bitrate_table = {
@@ -17,7 +27,41 @@ bitrate_table = {
     "360p": 800,
     "240p": 500,
 }
-standard_resolutions = ["1080p", "720p", "360p", "240p"]
+
+# HEVC and AV1 reach the quality of H.264 at roughly 60% and 50% of its bitrate
+codec_bitrate_tables = {
+    "libx264": bitrate_table,
+    "libx265": {
+        "2160p": 8400,
+        "1440p": 4800,
+        "1080p": 2700,
+        "720p": 1500,
+        "480p": 600,
+        "360p": 480,
+        "240p": 300,
+    },
+    "libsvtav1": {
+        "2160p": 7000,
+        "1440p": 4000,
+        "1080p": 2250,
+        "720p": 1250,
+        "480p": 500,
+        "360p": 400,
+        "240p": 250,
+    },
+}
+# Extra encoder options; hvc1 tagging is what Apple players require for HEVC in MP4
+codec_args = {
+    "libx264": [],
+    "libx265": ["-tag:v", "hvc1"],
+    "libsvtav1": ["-preset", "8"],
+}
+# Suffix of the output files and directories of each codec, H.264 keeps the original names
+codec_labels = {
+    "libx264": "",
+    "libx265": "hevc",
+    "libsvtav1": "av1",
+}
 
 
 def get_basename_directory_path(file_path: str) -> str:
@@ -39,69 +83,369 @@ def get_basename_directory_path(file_path: str) -> str:
     return os.path.join(parent_dir, file_basename)
 
 
-def calculate_bitrate(resolution):
-    return bitrate_table.get(resolution, 1000)  # Default to 1000k if resolution not found
+def calculate_bitrate(resolution, codec="libx264"):
+    return codec_bitrate_tables[codec].get(resolution, 1000)  # Default to 1000k if resolution not found
 
 
-def get_video_dimensions(video_path):
+def get_rendition_name(resolution: str, codec: str) -> str:
+    """
+    Returns the name used for a rendition's files, checkpoints and DASH subdirectory.
+
+    Args:
+        resolution (str): The quality, like "720p".
+        codec (str): The ffmpeg encoder, like "libx265".
+
+    Returns:
+        str: E.g. "720p" for H.264 and "720p_hevc" for HEVC.
+    """
+    return f"{resolution}_{codec_labels[codec]}" if codec_labels[codec] else resolution
+
+
+def remove_checkpoint(checkpoint_file: str) -> None:
+    """
+    Removes a job's checkpoint, and its staging directory once no other job uses it.
+
+    Args:
+        checkpoint_file (str): The job's "{base_name}.completed.json".
+    """
+    os.remove(checkpoint_file)
+    staging_root = os.path.dirname(checkpoint_file)
+    if not os.listdir(staging_root):
+        os.rmdir(staging_root)
+
+
+def fsync_directory(directory: str) -> None:
+    """
+    Flushes a directory's entries to disk, so renames inside it survive a crash.
+
+    Args:
+        directory (str): The directory to flush.
+    """
+    fd = os.open(directory, os.O_RDONLY)
     try:
-        if not os.path.isfile(f"{video_path}"):
-            raise FileNotFoundError(f'Video file not found')
-
-        # Run ffprobe command to get video information
-        command = [
-            "ffprobe",
-            "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height",
-            "-of", "json",
-            video_path
-        ]
-        result = subprocess.run(command, capture_output=True, text=True)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_tree_durably(src_dir: str, dst_dir: str) -> None:
+    """
+    Copies a directory tree in one sequential pass and fsyncs every file and directory,
+    so that nothing of it is lost once the copy returns.
+
+    Args:
+        src_dir (str): The directory to copy.
+        dst_dir (str): The destination, which must not exist yet.
+    """
+    for root, dirs, files in os.walk(src_dir):
+        target_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(target_root)
+        for file in files:
+            target_file = os.path.join(target_root, file)
+            shutil.copy2(os.path.join(root, file), target_file)
+            with open(target_file, "rb") as copied:
+                os.fsync(copied.fileno())
+    for root, dirs, files in os.walk(dst_dir, topdown=False):
+        fsync_directory(root)
+
+
+def exchange_paths(path_a: str, path_b: str) -> bool:
+    """
+    Atomically swaps two paths on the same filesystem with renameat2(RENAME_EXCHANGE).
+
+    Args:
+        path_a (str): The first path.
+        path_b (str): The second path.
+
+    Returns:
+        bool: False if the platform or filesystem does not support the exchange.
+    """
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+    if renameat2 is None:
+        return False
+
+    at_fdcwd, rename_exchange = -100, 2
+    if renameat2(at_fdcwd, os.fsencode(path_a), at_fdcwd, os.fsencode(path_b), rename_exchange) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), path_a)
+
+
+def publish_directory(staging_dir: str, final_dir: str, keep: tuple = ("encoding.log",)) -> None:
+    """
+    Replaces final_dir with a fully written staging_dir. Where renameat2 is available
+    the two are exchanged atomically, so readers see either the old tree or the new
+    one. Elsewhere, two renames leave a brief moment in which final_dir does not exist.
+    final_dir must belong to a single title, as everything else in it is replaced.
+
+    If staging_dir is on another filesystem (e.g. local scratch space), the tree is
+    first copied next to final_dir in one bulk pass and fsynced.
+
+    Args:
+        staging_dir (str): The finished directory.
+        final_dir (str): The directory to replace.
+        keep (tuple of str): Files carried over from the old final_dir, like the job log.
+    """
+    final_parent = os.path.dirname(os.path.abspath(final_dir))
+    os.makedirs(final_parent, exist_ok=True)
+
+    if os.stat(staging_dir).st_dev != os.stat(final_parent).st_dev:
+        incoming_dir = f"{final_dir}.incoming-{os.getpid()}"
+        if os.path.exists(incoming_dir):
+            shutil.rmtree(incoming_dir)
+        copy_tree_durably(staging_dir, incoming_dir)
+        shutil.rmtree(staging_dir)
+        staging_dir = incoming_dir
+
+    if not os.path.exists(final_dir):
+        os.rename(staging_dir, final_dir)
+        fsync_directory(final_parent)
+        return
+
+    if exchange_paths(staging_dir, final_dir):
+        old_dir = staging_dir
+    else:
+        old_dir = f"{final_dir}.old-{os.getpid()}"
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(final_dir, old_dir)
+        os.rename(staging_dir, final_dir)
+    fsync_directory(final_parent)
+
+    # Renaming keeps open file handles valid, so the job log keeps being written to
+    for name in keep:
+        if os.path.exists(os.path.join(old_dir, name)):
+            os.replace(os.path.join(old_dir, name), os.path.join(final_dir, name))
+    shutil.rmtree(old_dir)
+
+
+def publish_files(staging_dir: str, final_dir: str) -> None:
+    """
+    Publishes the files of staging_dir into final_dir one by one, each with an atomic
+    rename, leaving every other file in final_dir alone. Used for directories that
+    several titles may share, like the MP4 directory. staging_dir is only removed once
+    every file is published, so an interrupted run can publish it again.
 
-        # Parse the JSON output
-        video_info = j_loads(result.stdout)
-        width = video_info['streams'][0]['width']
-        height = video_info['streams'][0]['height']
+    Each file is hardlinked next to its destination first, or copied and fsynced if
+    staging_dir is on another filesystem.
+
+    Args:
+        staging_dir (str): The directory holding the finished files.
+        final_dir (str): The directory to publish them to.
+    """
+    os.makedirs(final_dir, exist_ok=True)
+    cross_device = os.stat(staging_dir).st_dev != os.stat(final_dir).st_dev
 
-        return width, height
-    except Exception as e:
-        print(f"Error getting dimensions of {video_path}: {e}")
-        return None, None
+    for entry in os.scandir(staging_dir):
+        if not entry.is_file():
+            continue
+        target_file = os.path.join(final_dir, entry.name)
+        # rename() is a no-op between two links to the same inode, so there is nothing to replace
+        if os.path.exists(target_file) and os.path.samefile(entry.path, target_file):
+            continue
+        part_file = f"{target_file}.part"
+        if os.path.lexists(part_file):
+            os.remove(part_file)
+        if cross_device:
+            shutil.copy2(entry.path, part_file)
+            with open(part_file, "rb") as copied:
+                os.fsync(copied.fileno())
+        else:
+            os.link(entry.path, part_file)
+        os.replace(part_file, target_file)
+    fsync_directory(final_dir)
+    shutil.rmtree(staging_dir)
 
 
-def filter_and_sort_qualities(qualities, video_height):
+def write_json_atomic(file_path: str, data) -> None:
     """
-    Filters and sorts the given list of qualities based on the video height.
-    Ensures the filtered list is never empty by adding the lowest quality if needed.
+    Writes data as JSON to a temporary file and renames it over file_path.
 
     Args:
-        qualities (list of str): List of qualities like ["480p", "360p"].
-        video_height (int): The height of the input video.
+        file_path (str): The destination path.
+        data: A JSON-serialisable value.
+    """
+    with open(f"{file_path}.part", "w") as file:
+        file.write(j_dumps(data))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{file_path}.part", file_path)
+
+
+def get_chunk_ranges(duration: float, chunk_duration: float) -> list:
+    """
+    Splits a duration into consecutive (start, length) chunks of at most chunk_duration seconds.
+
+    Args:
+        duration (float): The total duration in seconds, or 0 if unknown.
+        chunk_duration (float): The maximum chunk length in seconds.
 
     Returns:
-        list of str: Filtered and sorted list of qualities.
+        list of tuple: (start, length) pairs. A single (0, None) chunk if the duration is unknown.
     """
-    # Convert quality strings to integers for comparison
-    quality_heights = [int(q[:-1]) for q in qualities]
+    if duration <= 0 or chunk_duration <= 0:
+        return [(0.0, None)]
 
-    # Filter out qualities higher than the video height
-    filtered = [q for q, h in zip(qualities, quality_heights) if h <= video_height]
+    ranges = []
+    start = 0.0
+    while start < duration:
+        ranges.append((start, min(chunk_duration, duration - start)))
+        start += chunk_duration
+    return ranges
+
+
+def encode_rendition(vid_filename: str, output_file: str, video_args: list, duration: float,
+                     has_audio: bool = True, chunk_duration: float = 60, logger=None) -> list:
+    """
+    Encodes one rendition in time chunks. Each finished chunk is checkpointed in a staging
+    directory next to output_file. The joined result is published with an atomic rename.
+    A re-run after a crash or SIGKILL continues from the last completed chunk.
+
+    Args:
+        vid_filename (str): The path to the source video.
+        output_file (str): The path of the MP4 to produce.
+        video_args (list of str): ffmpeg video filter and encoder options, e.g. ["-c:v", "libx264", ...].
+        duration (float): The source duration in seconds, or 0 if unknown.
+        has_audio (bool): Whether the source has an audio stream to encode.
+        chunk_duration (float): The length of each checkpointed chunk in seconds.
+        logger (logging.Logger): The job logger.
+
+    Returns:
+        list of float: The speed factors reported by ffmpeg for the work done in this run.
+    """
+    output_name = os.path.splitext(os.path.basename(output_file))[0]
+    staging_dir = os.path.join(os.path.dirname(output_file), ".staging", output_name)
+
+    # Checkpoints from a run with other settings or another source cannot be reused
+    source_stat = os.stat(vid_filename)
+    settings = {
+        "source": os.path.abspath(vid_filename),
+        "source_size": source_stat.st_size,
+        "source_mtime": source_stat.st_mtime,
+        "video_args": video_args,
+        "chunk_duration": chunk_duration,
+        "chunk_format": "mp4",
+    }
+    settings_file = os.path.join(staging_dir, "settings.json")
+    if os.path.exists(settings_file):
+        with open(settings_file) as file:
+            if j_loads(file.read()) != settings:
+                shutil.rmtree(staging_dir)
+    if not os.path.exists(settings_file):
+        os.makedirs(staging_dir, exist_ok=True)
+        write_json_atomic(settings_file, settings)
+
+    speeds = []
+    chunk_files = []
+    for index, (start, length) in enumerate(get_chunk_ranges(duration, chunk_duration)):
+        chunk_file = os.path.join(staging_dir, f"chunk_{index:05d}.mp4")
+        chunk_files.append(chunk_file)
+        if os.path.exists(chunk_file):
+            continue
 
-    # Ensure the list is not empty; add the lowest quality if empty
-    if not filtered:
-        lowest_quality = min(qualities, key=lambda q: int(q[:-1]))
-        filtered.append(lowest_quality)
+        part_file = os.path.join(staging_dir, f"chunk_{index:05d}.mp4.part")
+        ffmpeg_cmd = ["ffmpeg", "-ss", f"{start:.3f}", "-i", vid_filename]
+        if length is not None:
+            ffmpeg_cmd += ["-t", f"{length:.3f}"]
+        # MP4 keeps the encoder's time base, where Matroska would round timestamps to 1 ms.
+        # vfr stops the MP4 muxer from duplicating a frame to fill the gap before the
+        # first frame after a chunk boundary that falls between two frames.
+        ffmpeg_cmd += ["-map", "0:v:0", *video_args, "-an", "-fps_mode", "vfr", "-f", "mp4", "-y", part_file]
+        result = subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+        os.replace(part_file, chunk_file)
+        speeds.append(parse_ffmpeg_speed(result.stderr))
+        if logger is not None:
+            logger.info(f"Checkpointed chunk {index} of {output_name}")
+
+    audio_file = os.path.join(staging_dir, "audio.m4a")
+    if has_audio and not os.path.exists(audio_file):
+        ffmpeg_cmd = [
+            "ffmpeg",
+            "-i", vid_filename,
+            "-map", "0:a:0",
+            "-vn",
+            "-c:a", "aac",
+            "-b:a", "128k",
+            "-f", "mp4",
+            "-y", f"{audio_file}.part"
+        ]
+        subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+        os.replace(f"{audio_file}.part", audio_file)
+
+    # Join the chunks without re-encoding and publish the finished file in one rename
+    concat_list = os.path.join(staging_dir, "chunks.txt")
+    with open(concat_list, "w") as file:
+        file.writelines(f"file '{os.path.basename(chunk_file)}'\n" for chunk_file in chunk_files)
+
+    part_output = os.path.join(staging_dir, "output.mp4.part")
+    ffmpeg_cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_list]
+    if has_audio:
+        ffmpeg_cmd += ["-i", audio_file, "-map", "0:v", "-map", "1:a"]
+    ffmpeg_cmd += ["-c", "copy", "-f", "mp4", "-y", part_output]
+    subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
 
-    # Sort the filtered list in descending order of resolution
-    filtered.sort(key=lambda q: int(q[:-1]), reverse=True)
+    with open(part_output, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(part_output, output_file)
+    shutil.rmtree(staging_dir)
+    if not os.listdir(os.path.dirname(staging_dir)):
+        os.rmdir(os.path.dirname(staging_dir))
 
-    return filtered
+    return [speed for speed in speeds if speed is not None]
 
 
 def encode_and_package(vid_filename, resolutions: list, output_dir: str = None, dash_dir: str = None,
-                       mp4_dir: str = None):
-    resolutions = filter_and_sort_qualities(resolutions, get_video_dimensions(vid_filename)[1])
+                       mp4_dir: str = None, segment_store: str = None, link_mode: str = "hardlink",
+                       metrics_path: str = None, chunk_duration: float = 60, scratch_dir: str = None,
+                       progressive: bool = False, seg_duration: float = 2, codecs: list = None):
+    """
+    Encodes a video into an MP4 ladder and packages it into DASH.
+
+    Args:
+        vid_filename (str): The path to the source video.
+        resolutions (list of str): Qualities to encode, like ["720p", "360p"].
+        output_dir (str): Defaults to "{basename}_output" next to the source.
+        dash_dir (str): Defaults to "{output_dir}/dash". It is replaced as a whole on
+            publishing, so it must not be shared with other titles.
+        mp4_dir (str): Defaults to "{output_dir}/mp4". May be shared by several titles.
+        segment_store (str): Optional content-addressed store directory. When set, the
+            MP4s and DASH segments become hardlink or symlink views onto the store.
+        link_mode (str): Either "hardlink" or "symlink", used with segment_store. Hardlinks
+            need the store on the same filesystem as mp4_dir and dash_dir.
+        metrics_path (str): Optional JSON-lines file that collects the timing of every stage.
+        chunk_duration (float): Seconds of video per checkpoint. An interrupted run resumes
+            from the last completed chunk of the rendition it was encoding.
+        scratch_dir (str): Optional fast local directory (NVMe, tmpfs) where the MP4s and
+            DASH segments are built. The finished trees are then published to mp4_dir and
+            dash_dir in one bulk copy with fsync and an atomic directory rename.
+        progressive (bool): If True, encode the lowest rendition first and publish a playable
+            manifest as soon as it is done. Each higher rendition is packaged into its own
+            "{dash_dir}/{resolution}" directory and added with an atomic manifest rewrite.
+            Published segments are never rewritten.
+        seg_duration (float): Target DASH segment duration in seconds.
+        codecs (list of str): Encoders of the ladder, any of codec_bitrate_tables. Defaults to
+            ["libx264"]. The H.264 ladder is always encoded first and published on its own
+            while the slower codecs encode, then replaced by a manifest listing every codec.
+    """
+    # Base name for output files
+    base_name = os.path.splitext(os.path.basename(vid_filename))[0]
+
+    if codecs is None:
+        codecs = ["libx264"]
+    unknown_codecs = [codec for codec in codecs if codec not in codec_bitrate_tables]
+    if unknown_codecs:
+        raise ValueError(f"Unsupported codecs: {unknown_codecs}")
+    # H.264 goes first, so the ladder every client can play is never held up by the slower codecs
+    codecs = sorted(set(codecs), key=lambda codec: (codec != "libx264", codecs.index(codec)))
+
+    with measure_stage("probe", base_name, metrics_path=metrics_path):
+        video_info = probe_video(vid_filename)
+    video_height = video_info["height"]
+    resolutions = filter_and_sort_qualities(resolutions, video_height)
+    if progressive:
+        resolutions.reverse()
 
     # If no output directory is specified, create one based on input filename
     if output_dir is None:
@@ -118,70 +462,223 @@ def encode_and_package(vid_filename, resolutions: list, output_dir: str = None,
     # Ensure output directory exists
     os.makedirs(dash_dir, exist_ok=True)
     os.makedirs(mp4_dir, exist_ok=True)
+    # Fail before encoding rather than after publishing if the store cannot be linked into
+    if segment_store is not None:
+        check_link_mode(mp4_dir, segment_store, link_mode)
+        check_link_mode(dash_dir, segment_store, link_mode)
+
+    # Segment names are not per title and publishing swaps the whole directory
+    other_manifests = [name for name in os.listdir(dash_dir)
+                       if name.endswith("_dash.mpd") and name != f"{base_name}_dash.mpd"]
+    if other_manifests:
+        raise ValueError(f"{dash_dir} already holds another title ({other_manifests[0]}), "
+                         f"give every title its own dash_dir")
+
+    # Build the outputs in scratch space if given, otherwise next to their final location.
+    # The scratch job directory is stable across runs so checkpoints can be resumed.
+    if scratch_dir is not None:
+        source_hash = hashlib.sha1(os.path.abspath(vid_filename).encode()).hexdigest()[:12]
+        job_dir = os.path.abspath(os.path.join(scratch_dir, f"{base_name}-{source_hash}"))
+        build_mp4_dir = os.path.join(job_dir, "mp4")
+        build_dash_dir = os.path.join(job_dir, "dash")
+    else:
+        job_dir = None
+        build_mp4_dir = os.path.abspath(mp4_dir)
+        build_dash_dir = os.path.abspath(f"{dash_dir}.partial")
+
+    # Configure logging for this job only
+    logger = get_job_logger(os.path.join(dash_dir, 'encoding.log'))
+    logger.info(f"Probed {vid_filename}: height {video_height}, renditions {resolutions}, codecs {codecs}")
 
-    # Base name for output files
-    base_name = os.path.splitext(os.path.basename(vid_filename))[0]
-
-    # Configure logging
-    logging.basicConfig(filename=os.path.join(dash_dir, 'encoding.log'), level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
-
-    # Save the current working directory
-    original_cwd = os.getcwd()
-
-    # Encode video into specified resolutions in MP4
-    encoded_files = []
-    for resolution in resolutions:
-        height = int(resolution.replace('p', ''))
-        output_file = f"{mp4_dir}/{base_name}_{resolution}.mp4"
-        os.makedirs(mp4_dir, exist_ok=True)
-
-        if get_video_dimensions(vid_filename)[1] == height:
-            # If video is already the desired quality, copy the file
-            shutil.copy(vid_filename, output_file)
-            logging.info(f"Copied video: {output_file}")
-            # print(f"Copied video: {output_file}")
-        else:
-            bitrate = calculate_bitrate(resolution)
-            ffmpeg_cmd = [
-                "ffmpeg",
-                "-i", vid_filename,
+    try:
+        # Renditions finished by an interrupted run of this job are not encoded again. The
+        # checkpoint lives outside build_mp4_dir, which publish_files removes once published.
+        checkpoint_dir = job_dir if job_dir is not None else os.path.join(build_mp4_dir, ".staging")
+        checkpoint_file = os.path.join(checkpoint_dir, f"{base_name}.completed.json")
+        source_stat = os.stat(vid_filename)
+        source = {
+            "path": os.path.abspath(vid_filename),
+            "size": source_stat.st_size,
+            "mtime": source_stat.st_mtime,
+        }
+        checkpoint = {"source": source, "renditions": {}}
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as file:
+                saved_checkpoint = j_loads(file.read())
+            # Renditions of a source that was replaced since the crash cannot be reused
+            if saved_checkpoint.get("source") == source:
+                checkpoint = saved_checkpoint
+        completed = checkpoint["renditions"]
+
+        dash_manifest_filename = f"{base_name}_dash.mpd"
+
+        # Marks the manifest as incomplete for find_mp4_files until the whole ladder is published
+        progressive_marker = os.path.join(dash_dir, ".progressive")
+        if progressive:
+            open(progressive_marker, "w").close()
+        rung_manifests = []
+
+        # Encode video into specified resolutions in MP4, one codec at a time
+        renditions = [(codec, resolution) for codec in codecs for resolution in resolutions]
+        encoded_files = {}
+        for index, (codec, resolution) in enumerate(renditions):
+            height = int(resolution.replace('p', ''))
+            rendition = get_rendition_name(resolution, codec)
+            output_file = f"{build_mp4_dir}/{base_name}_{rendition}.mp4"
+            os.makedirs(build_mp4_dir, exist_ok=True)
+            bitrate = calculate_bitrate(resolution, codec)
+            video_args = [
                 "-vf", f"scale=-2:{height}",
-                "-c:v", "libx264",
+                "-c:v", codec,
                 "-b:v", f"{bitrate}k",
-                "-c:a", "aac",
-                "-b:a", "128k",
-                "-y", output_file
+                *codec_args[codec],
             ]
-            subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
-            logging.info(f"Successfully encoded {resolution}")
-            # print(f"Encoded video: {output_file}")
-
-        encoded_files.append(os.path.abspath(output_file))
-    # Package encoded videos into DASH
-    # Change to the DASH directory
-    os.chdir(dash_dir)
-
-    dash_manifest_filename = f"{base_name}_dash.mpd"
-    ffmpeg_cmd = ["ffmpeg"]
-    for encoded_file in encoded_files:
-        ffmpeg_cmd += ["-i", encoded_file]
-    for i in range(len(encoded_files)):
-        ffmpeg_cmd += ["-map", str(i)]
-    ffmpeg_cmd += [
-        "-c", "copy",
-        "-f", "dash",
-        "-use_timeline", "1",
-        "-use_template", "1",
-        "-seg_duration", "2",
-        "-init_seg_name", "init-stream$RepresentationID$.m4s",
-        "-media_seg_name", "chunk-stream$RepresentationID$-$Number%05d$.m4s",
-        dash_manifest_filename
-    ]
-    subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
-    logging.info(f"DASH packaging complete: {dash_manifest_filename}")
-
-    os.chdir(original_cwd)
+            # Only an H.264 source can stand in for the libx264 rung it matches
+            copy_source = codec == "libx264" and video_info["codec"] == "h264" and video_height == height
+            rendition_settings = "copy" if copy_source else video_args
+
+            resumed = completed.get(rendition) == rendition_settings and os.path.exists(output_file)
+            if resumed:
+                logger.info(f"Resuming: {rendition} was already encoded")
+            elif copy_source:
+                # If video is already the desired quality, copy the file
+                with measure_stage("copy", base_name, logger, metrics_path, resolution=resolution) as span:
+                    shutil.copy(vid_filename, f"{output_file}.part")
+                    os.replace(f"{output_file}.part", output_file)
+                    span["bytes_in"] = span["bytes_out"] = os.path.getsize(output_file)
+                logger.info(f"Copied video: {output_file}")
+                # print(f"Copied video: {output_file}")
+            else:
+                with measure_stage("encode", base_name, logger, metrics_path, resolution=resolution,
+                                   codec=codec) as span:
+                    speeds = encode_rendition(vid_filename, output_file, video_args, video_info["duration"],
+                                              video_info["has_audio"], chunk_duration, logger)
+                    span["bytes_in"] = os.path.getsize(vid_filename)
+                    span["bytes_out"] = os.path.getsize(output_file)
+                    span["speed"] = sum(speeds) / len(speeds) if speeds else None
+                logger.info(f"Successfully encoded {rendition}")
+                # print(f"Encoded video: {output_file}")
+
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            completed[rendition] = rendition_settings
+            write_json_atomic(checkpoint_file, checkpoint)
+
+            encoded_files.setdefault(codec, []).append(os.path.abspath(output_file))
+
+            if progressive:
+                # Package this rendition on its own; only the first one carries the audio.
+                # merge_manifests groups the renditions of each codec into their own AdaptationSet.
+                rung_dir = os.path.join(dash_dir, rendition)
+                rung_manifest = os.path.join(rung_dir, f"{base_name}_{rendition}.mpd")
+                if not (resumed and os.path.exists(rung_manifest)):
+                    if job_dir is not None:
+                        rung_build_dir = os.path.join(job_dir, "dash", rendition)
+                    else:
+                        rung_build_dir = os.path.abspath(f"{rung_dir}.partial")
+                    if os.path.exists(rung_build_dir):
+                        shutil.rmtree(rung_build_dir)
+                    os.makedirs(rung_build_dir)
+
+                    maps = ["0"] if not rung_manifests else ["0:v"]
+                    ffmpeg_cmd = build_dash_command([output_file], maps,
+                                                    os.path.join(rung_build_dir, os.path.basename(rung_manifest)),
+                                                    seg_duration)
+                    with measure_stage("package", base_name, logger, metrics_path, resolution=resolution,
+                                       codec=codec) as span:
+                        result = subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+                        span["bytes_in"] = os.path.getsize(output_file)
+                        span["bytes_out"] = get_path_size(rung_build_dir)
+                        span["speed"] = parse_ffmpeg_speed(result.stderr)
+                    publish_directory(rung_build_dir, rung_dir, keep=())
+
+                rung_manifests.append((rendition, rung_manifest))
+                merge_manifests(rung_manifests, os.path.join(dash_dir, dash_manifest_filename))
+                logger.info(f"Published {rendition}, manifest lists {len(rung_manifests)} renditions")
+            elif len(codecs) > 1 and index == len(resolutions) - 1:
+                # Publish the H.264 ladder on its own while the slower codecs encode. The marker
+                # keeps the title queued for find_mp4_files until the combined manifest replaces it.
+                if os.path.exists(build_dash_dir):
+                    shutil.rmtree(build_dash_dir)
+                os.makedirs(build_dash_dir)
+                ffmpeg_cmd = build_ladder_command({codec: encoded_files[codec]},
+                                                  os.path.join(build_dash_dir, dash_manifest_filename),
+                                                  video_info["has_audio"], seg_duration)
+                with measure_stage("package", base_name, logger, metrics_path, codec=codec) as span:
+                    result = subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+                    span["bytes_in"] = sum(os.path.getsize(encoded_file) for encoded_file in encoded_files[codec])
+                    span["bytes_out"] = get_path_size(build_dash_dir)
+                    span["speed"] = parse_ffmpeg_speed(result.stderr)
+                open(os.path.join(build_dash_dir, ".progressive"), "w").close()
+                publish_directory(build_dash_dir, dash_dir)
+                logger.info(f"Published the H.264 ladder, encoding {codecs[1:]} next")
+
+        if progressive:
+            # The checkpoint goes last, so a kill while publishing resumes from the encoded MP4s
+            if job_dir is not None:
+                publish_files(build_mp4_dir, mp4_dir)
+                shutil.rmtree(job_dir)
+            else:
+                remove_checkpoint(checkpoint_file)
+
+            # Drop leftovers of earlier runs that the manifest no longer refers to
+            current_entries = {dash_manifest_filename, "encoding.log", ".progressive",
+                               *(get_rendition_name(resolution, codec) for codec, resolution in renditions)}
+            for entry in os.listdir(dash_dir):
+                if entry not in current_entries:
+                    entry_path = os.path.join(dash_dir, entry)
+                    if os.path.isdir(entry_path):
+                        shutil.rmtree(entry_path)
+                    else:
+                        os.remove(entry_path)
+            os.remove(progressive_marker)
+            logger.info(f"Progressive publishing complete: {dash_manifest_filename}")
+
+        # Package encoded videos into DASH
+        # Build the DASH tree away from the final one, so a crash never leaves a manifest
+        # that find_mp4_files would take for a finished title
+        if not progressive:
+            if os.path.exists(build_dash_dir):
+                shutil.rmtree(build_dash_dir)
+            os.makedirs(build_dash_dir)
+
+            ffmpeg_cmd = build_ladder_command(encoded_files, os.path.join(build_dash_dir, dash_manifest_filename),
+                                              video_info["has_audio"], seg_duration)
+            with measure_stage("package", base_name, logger, metrics_path) as span:
+                result = subprocess.run(ffmpeg_cmd, capture_output=True, check=True)
+                span["bytes_in"] = sum(os.path.getsize(encoded_file)
+                                       for codec_files in encoded_files.values() for encoded_file in codec_files)
+                span["bytes_out"] = get_path_size(build_dash_dir)
+                span["speed"] = parse_ffmpeg_speed(result.stderr)
+            logger.info(f"DASH packaging complete: {dash_manifest_filename}")
+
+            # Publish the finished trees, the manifest last
+            with measure_stage("publish", base_name, logger, metrics_path) as span:
+                span["bytes_in"] = get_path_size(build_dash_dir)
+                if job_dir is not None:
+                    span["bytes_in"] += get_path_size(build_mp4_dir)
+                    publish_files(build_mp4_dir, mp4_dir)
+                publish_directory(build_dash_dir, dash_dir)
+                span["bytes_out"] = span["bytes_in"]
+            # The checkpoint goes last, so a kill while publishing resumes from the encoded MP4s
+            if job_dir is not None:
+                shutil.rmtree(job_dir)
+            else:
+                remove_checkpoint(checkpoint_file)
+            logger.info(f"Published {mp4_dir} and {dash_dir}")
+
+        # Replace the outputs with views onto the content-addressed store
+        if segment_store is not None:
+            with measure_stage("store", base_name, logger, metrics_path) as span:
+                saved_bytes = store_tree(mp4_dir, segment_store, link_mode)
+                saved_bytes += store_tree(dash_dir, segment_store, link_mode)
+                span["bytes_in"] = get_path_size(mp4_dir) + get_path_size(dash_dir)
+                span["bytes_out"] = span["bytes_in"] - saved_bytes
+            logger.info(f"Deduplicated {saved_bytes} bytes into {segment_store}")
+    except Exception:
+        logger.exception(f"Encoding {vid_filename} failed")
+        raise
+    finally:
+        close_job_logger(logger)
 
 
 def is_contained_in_dir(path: str, containing_dir: str):
@@ -258,7 +755,8 @@ def find_mp4_files(directory: str, exclude: list = None, overwrite_dash=True) ->
             if os.path.isdir(dash_dir) and not overwrite_dash:
                 mpd_file = os.path.join(dash_dir, f"{base_name}_dash.mpd")
                 # print(mpd_file, os.path.exists(mpd_file))
-                if os.path.exists(mpd_file):
+                # A progressive run that has not published every rendition yet is not finished
+                if os.path.exists(mpd_file) and not os.path.exists(os.path.join(dash_dir, ".progressive")):
                     continue
             result.append(mp4_path)
 
@@ -267,13 +765,58 @@ def find_mp4_files(directory: str, exclude: list = None, overwrite_dash=True) ->
 
 if __name__ == "__main__":
     video_dir = "../stickman-animation"
-
-    mp4_files = find_mp4_files(video_dir, exclude=[f"{video_dir}/mp4/stickman-animation_1080p.mp4"])
-    print("Discovered MP4s:", mp4_files)
-    for input_video_filename in tqdm(mp4_files, desc="Video encoding"):
-        # input_video_filename = "supreme-dualist-stickman-animation.mp4"  # Replace with your video filename
-        # print(input_video_filename)
-        try:
-            encode_and_package(input_video_filename, standard_resolutions)
-        except Exception as e:
-            continue
+    segment_store_dir = None  # e.g. "../segment_store" to deduplicate outputs
+    scratch_dir = os.environ.get("ENCODER_SCRATCH_DIR")  # e.g. a local NVMe or tmpfs mount
+    progressive = False  # Publish the lowest rendition first, then add the others as they finish
+    codecs = ["libx264"]  # e.g. ["libx264", "libx265", "libsvtav1"] for clients that support newer codecs
+    metrics_path = os.path.abspath(f"{video_dir}/encoding_metrics.jsonl")
+    prometheus_path = os.path.abspath(f"{video_dir}/encoding_metrics.prom")
+    throughput_model_path = os.path.abspath(f"{video_dir}/throughput_model.json")
+    dry_run = os.environ.get("ENCODER_DRY_RUN") == "1"  # Only print the planned schedule
+
+    # "local" encodes on this host, "coordinator" serves jobs to remote "worker"s
+    role = os.environ.get("ENCODER_ROLE", "local")
+    coordinator_host, _, coordinator_port = os.environ.get("ENCODER_COORDINATOR", "0.0.0.0:8765").partition(":")
+
+    if role == "worker":
+        run_worker(encode_and_package, coordinator_host, int(coordinator_port), scratch_dir=scratch_dir)
+    else:
+        mp4_files = find_mp4_files(video_dir, exclude=[f"{video_dir}/mp4/stickman-animation_1080p.mp4"])
+        print("Discovered MP4s:", mp4_files)
+
+        # Start the longest jobs first, so no giant file is left as the tail of the batch.
+        # The probe behind each cost estimate is shared by the planner and the scheduler.
+        job_costs = {mp4_file: estimate_job_cost(mp4_file) for mp4_file in mp4_files}
+        plan = plan_jobs(mp4_files, standard_resolutions, job_costs, load_model(throughput_model_path),
+                         codecs=codecs)
+        print_plan(plan)
+        if dry_run:
+            raise SystemExit(0)
+        mp4_files = plan["order"]
+        durations = {}
+
+        if role == "coordinator":
+            # Workers read the sources from shared storage and stream their outputs and spans back.
+            # The coordinator writes metrics_path and links the uploads into the segment store.
+            results = run_coordinator(mp4_files, standard_resolutions, host=coordinator_host,
+                                      port=int(coordinator_port), mode="upload",
+                                      segment_store=segment_store_dir, metrics_path=metrics_path,
+                                      progressive=progressive, codecs=codecs)
+        else:
+            # Run the encodes in parallel, admitting new ones only while the host has headroom
+            results = run_with_load_control(encode_and_package, mp4_files, standard_resolutions,
+                                            segment_store=segment_store_dir, metrics_path=metrics_path,
+                                            scratch_dir=scratch_dir, progressive=progressive,
+                                            codecs=codecs, durations=durations, costs=job_costs)
+        for input_video_filename, error in results.items():
+            if error is not None:
+                print(f"Error encoding {input_video_filename}: {error}")
+
+        if os.path.exists(metrics_path):
+            write_prometheus_textfile(metrics_path, prometheus_path)
+
+        # Learn this host's throughput from the jobs that succeeded
+        observations = [(plan["work_units"][path], seconds) for path, seconds in durations.items()
+                        if results.get(path) is None]
+        model = update_model(throughput_model_path, observations)
+        print(f"Throughput model: {model['seconds_per_unit']:.3g} s per pixel-frame-rendition")
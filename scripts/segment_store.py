@@ -0,0 +1,259 @@
+import errno
+import hashlib
+import os
+import shutil
+
+# File extensions written by encode_and_package that are worth deduplicating
+stored_extensions = (".mp4", ".m4s", ".m4v", ".m4a")
+
+# Number of leading hex characters used for each level of directory sharding
+shard_width = 2
+shard_depth = 2
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Computes the SHA-256 digest of a file without loading it into memory.
+
+    Args:
+        file_path (str): The path to the file.
+        chunk_size (int): Number of bytes read per iteration.
+
+    Returns:
+        str: The hexadecimal digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_blob_path(store_dir: str, digest: str) -> str:
+    """
+    Returns the path of the blob holding the given digest, e.g.
+    "{store_dir}/ab/cd/abcd...", without checking or creating it.
+
+    Args:
+        store_dir (str): The root directory of the content-addressed store.
+        digest (str): The hexadecimal digest of the blob.
+
+    Returns:
+        str: The path to the blob.
+    """
+    shards = [digest[i * shard_width:(i + 1) * shard_width] for i in range(shard_depth)]
+    return os.path.join(store_dir, *shards, digest)
+
+
+def add_to_store(file_path: str, store_dir: str) -> str:
+    """
+    Adds a file to the content-addressed store if an identical blob is not already present.
+
+    Blobs are made read-only, so a later `ffmpeg -y` cannot rewrite a shared inode in place.
+
+    Args:
+        file_path (str): The path to the file to store.
+        store_dir (str): The root directory of the content-addressed store.
+
+    Returns:
+        str: The path to the blob holding the file contents.
+    """
+    blob_path = get_blob_path(store_dir, hash_file(file_path))
+    if os.path.exists(blob_path):
+        return blob_path
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    # Link (or, across filesystems, copy) into a temporary name first so a crash never
+    # leaves a truncated blob behind. Linking shares the inode, so no data is written twice.
+    tmp_path = os.path.join(os.path.dirname(blob_path), f".tmp-{os.getpid()}-{os.path.basename(blob_path)}")
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        try:
+            os.link(file_path, tmp_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(file_path, tmp_path)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, blob_path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return blob_path
+
+
+def get_device(path: str) -> int:
+    """
+    Returns the device of a path, or of its nearest existing parent if the path
+    has not been created yet.
+
+    Args:
+        path (str): The path to check.
+
+    Returns:
+        int: The st_dev of the path.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def check_link_mode(tree_dir: str, store_dir: str, link_mode: str = "hardlink") -> None:
+    """
+    Raises ValueError if tree_dir cannot become a view onto the store with the given
+    link mode, because hardlinks cannot cross filesystems.
+
+    Args:
+        tree_dir (str): The directory to deduplicate.
+        store_dir (str): The root directory of the content-addressed store.
+        link_mode (str): Either "hardlink" or "symlink".
+    """
+    if link_mode not in ("hardlink", "symlink"):
+        raise ValueError(f"Unknown link mode: {link_mode}")
+    if link_mode == "hardlink" and get_device(tree_dir) != get_device(store_dir):
+        raise ValueError(f"{tree_dir} and the segment store {store_dir} are on different filesystems, "
+                         f"use link_mode=\"symlink\" or a store on the same filesystem")
+
+
+def link_from_store(blob_path: str, file_path: str, link_mode: str = "hardlink") -> None:
+    """
+    Atomically replaces file_path with a link to blob_path.
+
+    Args:
+        blob_path (str): The path to the blob in the store.
+        file_path (str): The path that should become a view onto the blob.
+        link_mode (str): Either "hardlink" or "symlink".
+    """
+    if link_mode not in ("hardlink", "symlink"):
+        raise ValueError(f"Unknown link mode: {link_mode}")
+
+    # rename() is a no-op between two links to the same inode, so there is nothing to replace
+    if link_mode == "hardlink" and os.path.exists(file_path) and os.path.samefile(blob_path, file_path):
+        return
+
+    tmp_path = f"{file_path}.link-{os.getpid()}"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+    if link_mode == "hardlink":
+        os.link(blob_path, tmp_path)
+    else:
+        os.symlink(os.path.abspath(blob_path), tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def store_tree(tree_dir: str, store_dir: str, link_mode: str = "hardlink") -> int:
+    """
+    Moves every segment, init file and MP4 under tree_dir into the store and
+    replaces them with links, turning tree_dir into a view onto the store.
+
+    Args:
+        tree_dir (str): The directory to deduplicate, e.g. a "{base}_output" directory.
+        store_dir (str): The root directory of the content-addressed store.
+        link_mode (str): Either "hardlink" or "symlink".
+
+    Returns:
+        int: The number of bytes that no longer occupy space of their own.
+    """
+    # Checked up front, so a failing link never leaves a blob nothing refers to
+    check_link_mode(tree_dir, store_dir, link_mode)
+    saved_bytes = 0
+    for root, dirs, files in os.walk(tree_dir):
+        for file in files:
+            if not file.endswith(stored_extensions):
+                continue
+
+            file_path = os.path.join(root, file)
+            if os.path.islink(file_path):
+                continue
+
+            blob_path = get_blob_path(store_dir, hash_file(file_path))
+            if os.path.exists(blob_path):
+                if os.path.samefile(blob_path, file_path):
+                    continue
+                saved_bytes += os.path.getsize(file_path)
+            else:
+                blob_path = add_to_store(file_path, store_dir)
+            link_from_store(blob_path, file_path, link_mode)
+
+    return saved_bytes
+
+
+def find_symlinked_blobs(roots: list, store_dir: str) -> set:
+    """
+    Collects the blobs referenced by symlinks under the given roots.
+
+    Args:
+        roots (list of str): Directories holding per-title DASH trees.
+        store_dir (str): The root directory of the content-addressed store.
+
+    Returns:
+        set of str: Real paths of referenced blobs.
+    """
+    store_dir = os.path.realpath(store_dir)
+    referenced = set()
+    for root_dir in roots:
+        for root, dirs, files in os.walk(root_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                if not os.path.islink(file_path):
+                    continue
+                target = os.path.realpath(file_path)
+                if target.startswith(store_dir + os.sep):
+                    referenced.add(target)
+    return referenced
+
+
+def collect_garbage(store_dir: str, roots: list = None, dry_run: bool = False) -> list[str]:
+    """
+    Removes blobs no title refers to anymore.
+
+    A blob is referenced if it has a hardlink besides its own store entry, or if a
+    symlink under one of the given roots points at it. Symlink views are only
+    detected when their roots are passed in, so pass every root when using symlinks.
+
+    Args:
+        store_dir (str): The root directory of the content-addressed store.
+        roots (list of str): Directories holding symlink views onto the store.
+        dry_run (bool): If True, report unreferenced blobs without removing them.
+
+    Returns:
+        List[str]: The paths of removed (or removable, with dry_run) blobs.
+    """
+    referenced = find_symlinked_blobs(roots or [], store_dir)
+    removed = []
+
+    for root, dirs, files in os.walk(store_dir):
+        for file in files:
+            blob_path = os.path.join(root, file)
+
+            # Leftovers of an interrupted add_to_store
+            if file.startswith(".tmp-"):
+                removed.append(blob_path)
+            elif os.stat(blob_path).st_nlink > 1 or os.path.realpath(blob_path) in referenced:
+                continue
+            else:
+                removed.append(blob_path)
+
+            if not dry_run:
+                os.remove(blob_path)
+
+    # Drop empty shard directories
+    if not dry_run:
+        for root, dirs, files in os.walk(store_dir, topdown=False):
+            if root != store_dir and not os.listdir(root):
+                os.rmdir(root)
+
+    return removed
+
+
+if __name__ == "__main__":
+    segment_store_dir = "../segment_store"
+    video_dir = "../stickman-animation"
+
+    unreferenced = collect_garbage(segment_store_dir, roots=[video_dir])
+    print(f"Removed {len(unreferenced)} unreferenced blobs")
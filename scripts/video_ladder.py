@@ -0,0 +1,31 @@
+# The qualities every title is encoded into, highest first
+standard_resolutions = ["1080p", "720p", "360p", "240p"]
+
+
+def filter_and_sort_qualities(qualities, video_height):
+    """
+    Filters and sorts the given list of qualities based on the video height.
+    Ensures the filtered list is never empty by adding the lowest quality if needed.
+
+    Args:
+        qualities (list of str): List of qualities like ["480p", "360p"].
+        video_height (int): The height of the input video.
+
+    Returns:
+        list of str: Filtered and sorted list of qualities.
+    """
+    # Convert quality strings to integers for comparison
+    quality_heights = [int(q[:-1]) for q in qualities]
+
+    # Filter out qualities higher than the video height
+    filtered = [q for q, h in zip(qualities, quality_heights) if h <= video_height]
+
+    # Ensure the list is not empty; add the lowest quality if empty
+    if not filtered:
+        lowest_quality = min(qualities, key=lambda q: int(q[:-1]))
+        filtered.append(lowest_quality)
+
+    # Sort the filtered list in descending order of resolution
+    filtered.sort(key=lambda q: int(q[:-1]), reverse=True)
+
+    return filtered
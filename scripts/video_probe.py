@@ -0,0 +1,122 @@
+import os
+import subprocess
+from json import loads as j_loads
+
+
+def probe_video(video_path: str) -> dict:
+    """
+    Probes the first video stream and the container of a file with ffprobe.
+
+    Args:
+        video_path (str): The path to the video file.
+
+    Returns:
+        dict: The codec, width, height and fps of the video stream, the duration in
+        seconds, and whether the file has an audio stream.
+    """
+    if not os.path.isfile(f"{video_path}"):
+        raise FileNotFoundError(f'Video file not found: {video_path}')
+
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name,width,height,avg_frame_rate:format=duration",
+        "-of", "json",
+        video_path
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+
+    video_info = j_loads(result.stdout)
+    streams = video_info['streams']
+    video_streams = [s for s in streams if s.get('codec_type') == "video"]
+    if not video_streams:
+        raise ValueError(f"No video stream in {video_path}")
+
+    stream = video_streams[0]
+    return {
+        "codec": stream.get('codec_name'),
+        "width": int(stream['width']),
+        "height": int(stream['height']),
+        "fps": parse_frame_rate(stream.get('avg_frame_rate', "0/0")),
+        "duration": float(video_info.get('format', {}).get('duration', 0) or 0),
+        "has_audio": any(s.get('codec_type') == "audio" for s in streams),
+    }
+
+
+def parse_frame_rate(frame_rate: str) -> float:
+    """
+    Converts an ffprobe rational like "30000/1001" into frames per second.
+
+    Args:
+        frame_rate (str): The rational frame rate.
+
+    Returns:
+        float: Frames per second, or 0.0 if unknown.
+    """
+    numerator, _, denominator = frame_rate.partition("/")
+    try:
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def probe_media_details(video_path: str, gop_window: float = 30) -> dict:
+    """
+    Probes the codec, bitrate and GOP structure of a file for inventory reports. The
+    keyframe spacing is measured from the packet headers of the first gop_window
+    seconds only, so the whole file is never read.
+
+    Args:
+        video_path (str): The path to the video file.
+        gop_window (float): Seconds of packets to read for the GOP measurement.
+
+    Returns:
+        dict: The size, duration, overall bitrate, video codec, profile, pixel format,
+        width, height, fps, video bitrate and B-frame use, the audio codec (None without
+        audio), and the mean and longest keyframe interval in seconds (None if the window
+        holds fewer than two keyframes).
+    """
+    if not os.path.isfile(f"{video_path}"):
+        raise FileNotFoundError(f'Video file not found: {video_path}')
+
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-read_intervals", f"%+{gop_window}",
+        "-show_entries", "stream=index,codec_type,codec_name,profile,width,height,avg_frame_rate,pix_fmt,"
+                         "bit_rate,has_b_frames:format=duration,bit_rate:packet=stream_index,pts_time,flags",
+        "-of", "json",
+        video_path
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+
+    video_info = j_loads(result.stdout)
+    streams = video_info.get('streams', [])
+    video_streams = [s for s in streams if s.get('codec_type') == "video"]
+    audio_streams = [s for s in streams if s.get('codec_type') == "audio"]
+    if not video_streams:
+        raise ValueError(f"No video stream in {video_path}")
+
+    stream = video_streams[0]
+    keyframes = sorted(float(p['pts_time']) for p in video_info.get('packets', [])
+                       if p.get('stream_index') == stream.get('index') and "K" in p.get('flags', "")
+                       and p.get('pts_time') not in (None, "N/A"))
+    intervals = [b - a for a, b in zip(keyframes, keyframes[1:])]
+
+    format_info = video_info.get('format', {})
+    return {
+        "size": os.path.getsize(video_path),
+        "duration": float(format_info.get('duration', 0) or 0),
+        "bitrate": int(format_info['bit_rate']) if format_info.get('bit_rate') else None,
+        "codec": stream.get('codec_name'),
+        "profile": stream.get('profile'),
+        "pix_fmt": stream.get('pix_fmt'),
+        "width": int(stream['width']),
+        "height": int(stream['height']),
+        "fps": parse_frame_rate(stream.get('avg_frame_rate', "0/0")),
+        "video_bitrate": int(stream['bit_rate']) if stream.get('bit_rate') else None,
+        "has_b_frames": bool(stream.get('has_b_frames')),
+        "audio_codec": audio_streams[0].get('codec_name') if audio_streams else None,
+        "keyframe_interval": sum(intervals) / len(intervals) if intervals else None,
+        "max_keyframe_interval": max(intervals) if intervals else None,
+    }